@@ -0,0 +1,265 @@
+"""
+Admin command line tools.
+
+    python -m app.admin export --out backup/
+    python -m app.admin import --in backup/
+    python -m app.admin rotate-kek
+    python -m app.admin set-admin alice [--revoke]
+
+Collections are streamed as gzip-compressed NDJSON (MongoDB extended JSON,
+so ObjectIds and datetimes survive the round trip), one file per
+collection. Export reads through a batched cursor ordered by `_id`. Each
+batch is written as its own complete gzip member and then checkpointed
+(last `_id` and file offset), so an export killed at any point resumes by
+cutting the file back to the last checkpoint and carrying on. Collections
+finished earlier in the same run are skipped. Once every collection is
+done the checkpoints are removed, so the next export starts from scratch
+instead of appending to a stale snapshot. Import uses unordered
+`insert_many` batches and skips documents that already exist, which makes
+re-running it safe.
+
+`rotate-kek` creates a new key-encryption key and rewraps the envelopes
+stored in `files` and `blobs`. Running API workers pick up the new key
+from the shared keyring on their next wrap/unwrap.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+from typing import List, Optional
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+
+from .utils.crypto_utils import rotate_kek
+
+DEFAULT_COLLECTIONS = ["users", "files", "blobs"]
+DEFAULT_BATCH_SIZE = 5000
+COMPRESS_LEVEL = 6  # gzip's default of 9 costs a lot of CPU for little gain
+DUPLICATE_KEY = 11000
+
+
+class Progress:
+    """Prints rows and rows/s for a running export or import."""
+
+    def __init__(self, label: str, report_every: float = 5.0):
+        self.label = label
+        self.report_every = report_every
+        self.rows = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+
+    def add(self, rows: int):
+        self.rows += rows
+        now = time.monotonic()
+        if now - self._last_report >= self.report_every:
+            self._last_report = now
+            self._print(now)
+
+    def done(self) -> dict:
+        now = time.monotonic()
+        self._print(now)
+        elapsed = now - self.started
+        return {"rows": self.rows, "seconds": elapsed, "rows_per_second": self.rows / elapsed if elapsed else 0.0}
+
+    def _print(self, now: float):
+        elapsed = now - self.started
+        rate = self.rows / elapsed if elapsed else 0.0
+        print(f"[{self.label}] {self.rows} rows in {elapsed:.1f}s ({rate:,.0f} rows/s)", file=sys.stderr)
+
+
+def _checkpoint_path(path: str) -> str:
+    return f"{path}.checkpoint"
+
+def _load_checkpoint(path: str) -> Optional[dict]:
+    try:
+        with open(_checkpoint_path(path), "r") as f:
+            return json_util.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+def _save_checkpoint(path: str, last_id, offset: int, complete: bool = False):
+    tmp_path = f"{_checkpoint_path(path)}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json_util.dumps({"last_id": last_id, "offset": offset, "complete": complete}))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, _checkpoint_path(path))
+
+def _remove_checkpoint(path: str):
+    try:
+        os.remove(_checkpoint_path(path))
+    except FileNotFoundError:
+        pass
+
+
+async def export_collection(
+    collection: AsyncIOMotorCollection,
+    path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    resume: bool = True
+) -> dict:
+    """
+    Streams a collection to a gzip NDJSON file in `_id` order.
+    With `resume`, continues after the last checkpointed `_id`, or does
+    nothing if the checkpoint says the file is already complete.
+    """
+    checkpoint = _load_checkpoint(path) if resume else None
+    if checkpoint and checkpoint.get("complete"):
+        print(f"[export {collection.name}] already complete, skipping", file=sys.stderr)
+        return {"rows": 0, "seconds": 0.0, "rows_per_second": 0.0, "skipped": True}
+    last_id = checkpoint["last_id"] if checkpoint else None
+    offset = checkpoint["offset"] if checkpoint else 0
+    if offset > (os.path.getsize(path) if os.path.exists(path) else 0):
+        raise SystemExit(f"Checkpoint for {path} is past the end of the file; rerun with --restart")
+    query = {} if last_id is None else {"_id": {"$gt": last_id}}
+
+    progress = Progress(f"export {collection.name}")
+    cursor = collection.find(query).sort("_id", 1).batch_size(batch_size)
+    batch: List[str] = []
+
+    with open(path, "r+b" if os.path.exists(path) else "wb") as out:
+        # Drop anything written after the last checkpoint (e.g. half a
+        # member from a killed run) before appending.
+        out.truncate(offset)
+        out.seek(offset)
+
+        def flush():
+            # A complete member per batch: the file is valid gzip up to
+            # every checkpoint, whatever happens afterwards.
+            out.write(gzip.compress("".join(batch).encode("utf-8"), compresslevel=COMPRESS_LEVEL))
+            out.flush()
+            os.fsync(out.fileno())
+            _save_checkpoint(path, last_id, out.tell())
+            progress.add(len(batch))
+            batch.clear()
+
+        async for doc in cursor:
+            batch.append(json_util.dumps(doc) + "\n")
+            last_id = doc["_id"]
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        _save_checkpoint(path, last_id, out.tell(), complete=True)
+
+    return progress.done()
+
+
+async def import_collection(
+    collection: AsyncIOMotorCollection,
+    path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> dict:
+    """
+    Streams a gzip NDJSON file into a collection with unordered batched
+    inserts. Documents whose `_id` already exists are skipped.
+    """
+    progress = Progress(f"import {collection.name}")
+    batch: List[dict] = []
+
+    async def flush():
+        try:
+            await collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Already-imported rows (e.g. from a previous partial run) are fine
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+            if errors:
+                raise
+        progress.add(len(batch))
+        batch.clear()
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(json_util.loads(line))
+            if len(batch) >= batch_size:
+                await flush()
+    if batch:
+        await flush()
+
+    return progress.done()
+
+
+def _get_database(mongo_uri: Optional[str]):
+    if mongo_uri:
+        return AsyncIOMotorClient(mongo_uri).get_database("cryptocloud")
+    from .db import db
+    return db
+
+
+async def run_export(db, out_dir: str, collections: List[str], batch_size: int, resume: bool) -> dict:
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {name: os.path.join(out_dir, f"{name}.ndjson.gz") for name in collections}
+    results = {}
+    for name, path in paths.items():
+        results[name] = await export_collection(db.get_collection(name), path, batch_size, resume)
+    # The whole export is done: only interrupted runs should ever resume
+    for path in paths.values():
+        _remove_checkpoint(path)
+    return results
+
+async def run_import(db, in_dir: str, collections: List[str], batch_size: int) -> dict:
+    results = {}
+    for name in collections:
+        path = os.path.join(in_dir, f"{name}.ndjson.gz")
+        if not os.path.exists(path):
+            print(f"Skipping {name}: {path} not found", file=sys.stderr)
+            continue
+        results[name] = await import_collection(db.get_collection(name), path, batch_size)
+    return results
+
+
+async def set_admin(db, username: str, is_admin: bool) -> dict:
+    result = await db.get_collection("users").update_one(
+        {"username": username}, {"$set": {"is_admin": is_admin}}
+    )
+    if result.matched_count == 0:
+        raise SystemExit(f"No such user: {username}")
+    return {"username": username, "is_admin": is_admin}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m app.admin", description="CryptoCloud admin tools")
+    parser.add_argument("--mongo-uri", help="MongoDB URI (defaults to MONGO_URI from settings)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export collections to compressed NDJSON")
+    export_parser.add_argument("--out", required=True, help="Output directory")
+    export_parser.add_argument("--restart", action="store_true", help="Ignore checkpoints and start over")
+
+    import_parser = subparsers.add_parser("import", help="Import collections from compressed NDJSON")
+    import_parser.add_argument("--in", dest="in_dir", required=True, help="Input directory")
+
+    subparsers.add_parser("rotate-kek", help="Create a new key-encryption key and rewrap stored data keys")
+
+    admin_parser = subparsers.add_parser("set-admin", help="Grant or revoke access to the operator stats endpoints")
+    admin_parser.add_argument("username")
+    admin_parser.add_argument("--revoke", action="store_true")
+
+    for sub in (export_parser, import_parser):
+        sub.add_argument("--collections", nargs="+", default=DEFAULT_COLLECTIONS)
+        sub.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+
+    args = parser.parse_args(argv)
+    db = _get_database(args.mongo_uri)
+
+    if args.command == "set-admin":
+        results = asyncio.run(set_admin(db, args.username, not args.revoke))
+    elif args.command == "rotate-kek":
+        rewrapped = asyncio.run(rotate_kek(db.get_collection("files"), db.get_collection("blobs")))
+        results = {"rewrapped": rewrapped}
+    elif args.command == "export":
+        results = asyncio.run(run_export(db, args.out, args.collections, args.batch_size, not args.restart))
+    else:
+        results = asyncio.run(run_import(db, args.in_dir, args.collections, args.batch_size))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,17 @@ class Settings(BaseSettings):
     s3_bucket_name: str
     s3_region: str
 
+    # SERVER-SIDE ENVELOPE ENCRYPTION:
+    # Key-encryption keys (KEKs) wrap a random data key per file.
+    kek_provider: str = "local"
+    local_kek_path: str = "kek.json"
+    data_key_cache_size: int = 1024  # Max unwrapped data keys kept in memory
+    data_key_cache_ttl: int = 300    # Seconds an unwrapped data key may be reused
+
+    # PROXIED DOWNLOAD DISK CACHE:
+    download_cache_dir: str = ".download_cache"
+    download_cache_max_bytes: int = 2 * 1024 * 1024 * 1024  # 2 GB per worker process
+
     class Config:
         env_file = ".env"
 
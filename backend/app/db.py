@@ -9,3 +9,6 @@ def get_user_collection():
 
 def get_file_collection():
     return db.get_collection("files")
+
+def get_blob_collection():
+    return db.get_collection("blobs")
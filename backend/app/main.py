@@ -1,9 +1,15 @@
 from fastapi import FastAPI
 from .routes import auth_routes, file_routes
+from .utils.file_events import close_file_event_broker
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI(title="CryptoCloud API")
 
+@app.on_event("shutdown")
+async def shutdown():
+    # Stop the shared change-stream watcher behind /files/events
+    await close_file_event_broker()
+
 app.include_router(auth_routes.router, prefix="/auth", tags=["Authentication"])
 app.include_router(file_routes.router, prefix="/files", tags=["Files"])
 
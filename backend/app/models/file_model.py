@@ -1,6 +1,7 @@
 from pydantic import BaseModel, Field
 from bson import ObjectId
 from datetime import datetime
+from typing import Optional
 
 class PyObjectId(ObjectId):
     @classmethod
@@ -24,6 +25,8 @@ class FileMetadata(BaseModel):
     upload_time: datetime = Field(default_factory=datetime.utcnow)
     file_path: str
     file_size: int
+    # Envelope for server-side encrypted files: {"kek_id", "wrapped_key"}
+    encryption: Optional[dict] = None
 
     class Config:
         from_attributes = True
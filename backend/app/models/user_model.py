@@ -30,6 +30,13 @@ class User(BaseModel):
     is_2fa_enabled: bool = Field(default=False)
     totp_secret: Optional[str] = None
 
+    # Bumped whenever the user's file set changes (finalize, rename, delete).
+    # Used to build ETags for the listing and storage endpoints.
+    files_version: int = Field(default=0)
+
+    # Operators only; granted with `python -m app.admin set-admin <username>`
+    is_admin: bool = Field(default=False)
+
     class Config:
         from_attributes = True
         populate_by_name = True
@@ -9,7 +9,9 @@ import boto3
 from ..models.user_model import UserCreate, User, UserResponse
 from ..utils.auth import get_password_hash, verify_password, create_access_token, get_current_user
 from ..db import get_user_collection
-from ..db import get_file_collection
+from ..db import get_file_collection, get_blob_collection
+from ..utils.disk_cache import get_download_cache
+from ..utils.dedup import release_blob
 
 from motor.motor_asyncio import AsyncIOMotorCollection
 from ..config import settings
@@ -52,7 +54,7 @@ async def register(user: UserCreate, users: AsyncIOMotorCollection = Depends(get
         )
     hashed_password = get_password_hash(user.password)
     # Create the full user document with 2FA fields disabled
-    new_user_data = {"username": user.username, "hashed_password": hashed_password, "is_2fa_enabled": False, "totp_secret": None}
+    new_user_data = {"username": user.username, "hashed_password": hashed_password, "is_2fa_enabled": False, "totp_secret": None, "files_version": 0}
     new_user = await users.insert_one(new_user_data)
     created_user = await users.find_one({"_id": new_user.inserted_id})
     
@@ -259,7 +261,8 @@ async def delete_account(
     request: DeleteAccountRequest,
     current_user: User = Depends(get_current_user),
     users: AsyncIOMotorCollection = Depends(get_user_collection),
-    files: AsyncIOMotorCollection = Depends(get_file_collection)
+    files: AsyncIOMotorCollection = Depends(get_file_collection),
+    blobs: AsyncIOMotorCollection = Depends(get_blob_collection)
 ):
     """
     Deletes a user's account and all associated data.
@@ -278,17 +281,30 @@ async def delete_account(
     user_files = await files.find({"owner_id": current_user.id}).to_list(length=None)
     
     if user_files:
-        # 3. Delete files from S3 bucket
-        s3_keys_to_delete = [{"Key": f["file_path"]} for f in user_files]
+        # 3. Delete files from S3 bucket. Deduplicated blobs are only
+        #    deleted once no other file references them.
+        s3_keys_to_delete = []
+        for f in user_files:
+            if "content_hash" in f:
+                unused_key = await release_blob(blobs, f["content_hash"])
+                if unused_key is not None:
+                    s3_keys_to_delete.append({"Key": unused_key})
+            else:
+                s3_keys_to_delete.append({"Key": f["file_path"]})
         try:
-            s3_client.delete_objects(
-                Bucket=settings.s3_bucket_name,
-                Delete={'Objects': s3_keys_to_delete}
-            )
+            if s3_keys_to_delete:
+                s3_client.delete_objects(
+                    Bucket=settings.s3_bucket_name,
+                    Delete={'Objects': s3_keys_to_delete}
+                )
         except Exception as e:
             # Don't stop the deletion, but log the error
             print(f"Error deleting S3 objects for user {current_user.id}: {e}")
 
+        cache = get_download_cache()
+        for key in s3_keys_to_delete:
+            cache.invalidate(key["Key"])
+
     # 4. Delete all file metadata from MongoDB
     await files.delete_many({"owner_id": current_user.id})
     
@@ -1,14 +1,25 @@
 import uuid
+import asyncio
+from urllib.parse import quote
 import boto3
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Header, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 
 from ..models.user_model import User
 from ..models.file_model import FileMetadata, FileMetadataResponse
-from ..utils.auth import get_current_user
-from ..db import get_file_collection
+from ..utils.auth import get_current_user, get_current_admin
+from ..utils.file_events import FileEventBroker, get_file_event_broker, format_sse
+from ..utils.crypto_utils import (
+    generate_data_key, unwrap_data_key, content_hasher,
+    StreamEncryptor, StreamDecryptor, STREAM_FORMAT
+)
+from ..utils.dedup import claim_blob, release_blob, dedup_stats
+from ..utils.disk_cache import DiskObjectCache, get_download_cache
+from ..utils.s3_streaming import stream_to_s3
+from ..db import get_file_collection, get_user_collection, get_blob_collection
 from ..config import settings
 from motor.motor_asyncio import AsyncIOMotorCollection
 
@@ -41,6 +52,31 @@ class DownloadResponse(BaseModel):
 class RenameRequest(BaseModel):
     new_filename: str
 
+# --- CONDITIONAL GET HELPERS ---
+# Every change to a user's files bumps `files_version` on their user document.
+# The listing and storage endpoints derive their ETag from it, so a client
+# that already has the current version gets a 304 without us touching the
+# files collection at all (the user document is already loaded by auth).
+async def bump_files_version(users: AsyncIOMotorCollection, user_id):
+    await users.update_one({"_id": user_id}, {"$inc": {"files_version": 1}})
+
+def _make_etag(kind: str, user: User) -> str:
+    return f'W/"{kind}-{user.id}-{user.files_version}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison: ignore the W/ prefix on either side
+    bare = etag.removeprefix("W/")
+    return "*" in candidates or any(tag.removeprefix("W/") == bare for tag in candidates)
+
+def _not_modified(etag: str) -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"}
+    )
+
 # --- NEW: REQUEST UPLOAD URL ---
 @router.post("/request-upload-url", response_model=UploadResponse)
 async def request_upload_url(
@@ -74,21 +110,44 @@ async def request_upload_url(
 async def finalize_upload(
     request: FinalizeRequest,
     current_user: User = Depends(get_current_user),
-    files: AsyncIOMotorCollection = Depends(get_file_collection)
+    files: AsyncIOMotorCollection = Depends(get_file_collection),
+    users: AsyncIOMotorCollection = Depends(get_user_collection)
 ):
     """
     Second step of upload. Client confirms the upload was successful.
     We now save the metadata to MongoDB.
     """
+    return await _save_file_metadata(
+        files, users, current_user,
+        filename=request.filename,
+        s3_key=request.s3_key,
+        file_size=request.file_size
+    )
+
+async def _save_file_metadata(
+    files: AsyncIOMotorCollection,
+    users: AsyncIOMotorCollection,
+    current_user: User,
+    filename: str,
+    s3_key: str,
+    file_size: int,
+    encryption: Optional[dict] = None,
+    content_hash: Optional[str] = None
+) -> FileMetadataResponse:
     file_metadata = {
-        "filename": request.filename,
+        "filename": filename,
         "owner_id": current_user.id,
-        "file_path": request.s3_key,  # We reuse 'file_path' to store the S3 key
+        "file_path": s3_key,  # We reuse 'file_path' to store the S3 key
         "upload_time": datetime.utcnow(),
-        "file_size": request.file_size
+        "file_size": file_size
     }
+    if encryption is not None:
+        file_metadata["encryption"] = encryption
+    if content_hash is not None:
+        file_metadata["content_hash"] = content_hash
     
     new_file = await files.insert_one(file_metadata)
+    await bump_files_version(users, current_user.id)
     created_file = await files.find_one({"_id": new_file.inserted_id})
     
     return FileMetadataResponse(
@@ -99,13 +158,103 @@ async def finalize_upload(
         file_size=created_file["file_size"]
     )
 
-# --- UNCHANGED: LIST FILES ---
-# This endpoint works perfectly as-is! It just reads from Mongo.
+def _delete_duplicate_upload(s3_key: str):
+    try:
+        s3_client.delete_object(Bucket=settings.s3_bucket_name, Key=s3_key)
+    except Exception as e:
+        print(f"Could not delete duplicate upload {s3_key}: {e}")
+
+# --- NEW: SERVER-PROXIED STREAMING UPLOAD ---
+@router.post("/upload", response_model=FileMetadataResponse)
+async def upload_file(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    filename: str,
+    encrypt: bool = False,
+    current_user: User = Depends(get_current_user),
+    files: AsyncIOMotorCollection = Depends(get_file_collection),
+    users: AsyncIOMotorCollection = Depends(get_user_collection),
+    blobs: AsyncIOMotorCollection = Depends(get_blob_collection)
+):
+    """
+    Upload path for clients that can't PUT to a presigned URL.
+    The raw request body is the file content. It is streamed into an S3
+    multipart upload (optionally encrypted server-side) without ever being
+    held in memory as a whole.
+
+    Server-side encrypted uploads are deduplicated: if the same content is
+    already stored, the new file just references the existing object.
+    """
+    content_type = request.headers.get("content-type", "application/octet-stream")
+
+    if not encrypt:
+        s3_key = f"{current_user.id}/{uuid.uuid4()}-{filename}"
+        try:
+            file_size = await stream_to_s3(
+                s3_client, settings.s3_bucket_name, s3_key, request.stream(),
+                content_type=content_type
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not upload file to S3: {e}")
+
+        return await _save_file_metadata(
+            files, users, current_user,
+            filename=filename,
+            s3_key=s3_key,
+            file_size=file_size
+        )
+
+    # Encrypted blobs may end up shared between users, so they don't live
+    # under a user prefix.
+    s3_key = f"blobs/{uuid.uuid4()}"
+    data_key, envelope = generate_data_key()
+    envelope["format"] = STREAM_FORMAT
+    hasher = content_hasher()
+
+    async def hashed_body():
+        async for chunk in request.stream():
+            hasher.update(chunk)
+            yield chunk
+
+    # The whole body is always uploaded, even when it turns out to be a
+    # duplicate, and the redundant copy is deleted after the response, so
+    # response timing doesn't reveal whether content exists.
+    try:
+        file_size = await stream_to_s3(
+            s3_client, settings.s3_bucket_name, s3_key, hashed_body(),
+            content_type=content_type,
+            encryptor=StreamEncryptor(data_key)
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not upload file to S3: {e}")
+
+    blob, is_new = await claim_blob(blobs, hasher.hexdigest(), s3_key, file_size, envelope)
+    if not is_new:
+        background_tasks.add_task(_delete_duplicate_upload, s3_key)
+
+    return await _save_file_metadata(
+        files, users, current_user,
+        filename=filename,
+        s3_key=blob["s3_key"],
+        file_size=file_size,
+        encryption=blob["encryption"],
+        content_hash=blob["_id"]
+    )
+
+# --- LIST FILES ---
+# Supports conditional GET: a matching If-None-Match gets a 304 straight
+# from the user's files_version, without querying the files collection.
 @router.get("/", response_model=List[FileMetadataResponse])
 async def list_files(
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None),
     current_user: User = Depends(get_current_user),
     files: AsyncIOMotorCollection = Depends(get_file_collection)
 ):
+    etag = _make_etag("files", current_user)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+
     user_files = await files.find({"owner_id": current_user.id}).to_list(length=None)
     
     response_list = []
@@ -119,8 +268,45 @@ async def list_files(
                 file_size=f.get("file_size", 0)  # Default to 0 if not present
             )
         )
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
     return response_list
 
+# --- NEW: LIVE FILE EVENTS (SSE) ---
+SSE_HEARTBEAT_SECONDS = 15
+
+@router.get("/events")
+async def file_events(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    broker: FileEventBroker = Depends(get_file_event_broker)
+):
+    """
+    Streams insert/rename/delete events for the current user's files as
+    Server-Sent Events, so clients don't have to poll the listing.
+    """
+    queue = broker.subscribe(current_user.id)
+
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            broker.unsubscribe(current_user.id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # --- NEW: GET DOWNLOAD URL ---
 @router.get("/download-url/{file_id}", response_model=DownloadResponse)
 async def get_download_url(
@@ -161,11 +347,153 @@ async def get_download_url(
 
     return DownloadResponse(download_url=download_url)
 
+# --- NEW: PROXIED DOWNLOAD (DISK CACHED) ---
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+def _decrypted_chunks(chunks, data_key: bytes):
+    decryptor = StreamDecryptor(data_key)
+    for chunk in chunks:
+        yield decryptor.update(chunk)
+    decryptor.finalize()
+
+def _read_file_chunks(f):
+    try:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            yield chunk
+    finally:
+        f.close()
+
+def _content_disposition(filename: str) -> str:
+    # Header values must be latin-1 and the plain form can't hold quotes,
+    # so anything beyond safe ASCII goes into RFC 5987 filename*=
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+@router.get("/download/{file_id}")
+async def download_file(
+    file_id: str,
+    current_user: User = Depends(get_current_user),
+    files: AsyncIOMotorCollection = Depends(get_file_collection),
+    cache: DiskObjectCache = Depends(get_download_cache)
+):
+    """
+    Streams a file through the API instead of handing out a presigned URL.
+    Hot objects are served from a local disk cache instead of S3.
+
+    Cache hits are streamed from an open file descriptor. This is not
+    zero-copy: uvicorn implements neither the ASGI zerocopy nor the pathsend
+    extension, so there is no way to hand the file to sendfile() from here.
+    """
+    from bson import ObjectId
+    try:
+        obj_id = ObjectId(file_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid file ID format")
+
+    file_metadata = await files.find_one({"_id": obj_id})
+
+    # Security check: Ensure the user owns this file
+    if not file_metadata or file_metadata["owner_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="File not found or access denied")
+
+    s3_key = file_metadata["file_path"]
+    envelope = file_metadata.get("encryption")
+    headers = {"Content-Disposition": _content_disposition(file_metadata["filename"])}
+
+    # Unwrap now: once the StreamingResponse starts, the 200 is already sent
+    # and a bad envelope could only cut the body short.
+    data_key = None
+    if envelope is not None:
+        try:
+            data_key = unwrap_data_key(envelope)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not unwrap file key: {e}")
+
+    # The cache is keyed by ETag, and whether to cache at all depends on the
+    # real object size (file_size comes from the client for presigned
+    # uploads). Remember both in the metadata so later downloads don't need
+    # a HEAD request first.
+    etag = file_metadata.get("s3_etag")
+    object_size = file_metadata.get("s3_size")
+    if etag is None or object_size is None:
+        try:
+            head = await asyncio.to_thread(
+                s3_client.head_object, Bucket=settings.s3_bucket_name, Key=s3_key
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not fetch file from S3: {e}")
+        etag, object_size = head["ETag"], head["ContentLength"]
+        await files.update_one({"_id": obj_id}, {"$set": {"s3_etag": etag, "s3_size": object_size}})
+
+    if not cache.should_cache(object_size):
+        # Too big for the cache: stream straight from S3
+        try:
+            s3_object = await asyncio.to_thread(
+                s3_client.get_object, Bucket=settings.s3_bucket_name, Key=s3_key
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Could not fetch file from S3: {e}")
+        chunks = s3_object["Body"].iter_chunks(DOWNLOAD_CHUNK_SIZE)
+        if envelope is not None:
+            chunks = _decrypted_chunks(chunks, data_key)
+        return StreamingResponse(chunks, media_type="application/octet-stream", headers=headers)
+
+    def fetch(tmp_path: str):
+        s3_object = s3_client.get_object(Bucket=settings.s3_bucket_name, Key=s3_key, IfMatch=etag)
+        written = 0
+        with open(tmp_path, "wb") as f:
+            for chunk in s3_object["Body"].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                # Never trust the recorded size with the local disk
+                if written > cache.max_entry_bytes:
+                    raise ValueError(f"{s3_key} is larger than the cache entry limit")
+                f.write(chunk)
+
+    try:
+        cached_file, size = await cache.open_or_fetch(s3_key, etag, fetch)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not fetch file from S3: {e}")
+
+    chunks = _read_file_chunks(cached_file)
+    if envelope is not None:
+        chunks = _decrypted_chunks(chunks, data_key)
+    else:
+        headers["Content-Length"] = str(size)
+    return StreamingResponse(chunks, media_type="application/octet-stream", headers=headers)
+
+@router.get("/dedup/stats")
+async def get_dedup_stats(
+    current_user: User = Depends(get_current_admin),
+    blobs: AsyncIOMotorCollection = Depends(get_blob_collection)
+):
+    """
+    Storage saved by deduplicating server-side encrypted uploads.
+    Admins only: global blob counts would tell an ordinary user whether
+    content they just uploaded already existed.
+    """
+    return await dedup_stats(blobs)
+
+@router.get("/cache/stats")
+async def get_download_cache_stats(
+    current_user: User = Depends(get_current_admin),
+    cache: DiskObjectCache = Depends(get_download_cache)
+):
+    """
+    Hit ratio and bytes served by the proxied download cache (admins only;
+    the numbers cover every user's downloads on this worker).
+    """
+    return cache.stats()
+
 @router.delete("/{file_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_file(
     file_id: str,
     current_user: User = Depends(get_current_user),
-    files: AsyncIOMotorCollection = Depends(get_file_collection)
+    files: AsyncIOMotorCollection = Depends(get_file_collection),
+    users: AsyncIOMotorCollection = Depends(get_user_collection),
+    blobs: AsyncIOMotorCollection = Depends(get_blob_collection),
+    cache: DiskObjectCache = Depends(get_download_cache)
 ):
     """
     Deletes a file from S3 and its metadata from MongoDB.
@@ -185,6 +513,20 @@ async def delete_file(
 
     s3_key = file_metadata["file_path"] # Get the S3 key
 
+    if "content_hash" in file_metadata:
+        # Deduplicated blob: drop our reference and only delete the S3
+        # object when no other file points at it anymore.
+        await files.delete_one({"_id": obj_id})
+        await bump_files_version(users, current_user.id)
+        unused_key = await release_blob(blobs, file_metadata["content_hash"])
+        if unused_key is not None:
+            try:
+                s3_client.delete_object(Bucket=settings.s3_bucket_name, Key=unused_key)
+            except Exception as e:
+                print(f"Could not delete unreferenced blob {unused_key} from S3: {e}")
+            cache.invalidate(unused_key)
+        return
+
     # 3. Delete the file from S3
     try:
         s3_client.delete_object(
@@ -195,9 +537,11 @@ async def delete_file(
         # If S3 fails, we stop. We don't want to delete the metadata
         # for a file that still exists.
         raise HTTPException(status_code=500, detail=f"Could not delete file from S3: {e}")
+    cache.invalidate(s3_key)
 
     # 4. Delete the file metadata from MongoDB
     await files.delete_one({"_id": obj_id})
+    await bump_files_version(users, current_user.id)
     
     # Return 204 No Content (success)
     return
@@ -208,12 +552,18 @@ class StorageUsageResponse(BaseModel):
 
 @router.get("/users/me/storage", response_model=StorageUsageResponse)
 async def get_storage_usage(
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None),
     current_user: User = Depends(get_current_user),
     files: AsyncIOMotorCollection = Depends(get_file_collection)
 ):
     """
     Calculates the total storage used by the current user.
     """
+    etag = _make_etag("storage", current_user)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+
     # Define a user quota (e.g., 5GB)
     USER_QUOTA_BYTES = 5 * 1024 * 1024 * 1024  # 5 GB
 
@@ -229,6 +579,8 @@ async def get_storage_usage(
     if result:
         total_usage = result[0].get("total_usage", 0)
 
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
     return StorageUsageResponse(used=total_usage, quota=USER_QUOTA_BYTES)
 
 # --- NEW: RENAME FILE ENDPOINT ---
@@ -237,7 +589,8 @@ async def rename_file(
     file_id: str,
     request: RenameRequest,
     current_user: User = Depends(get_current_user),
-    files: AsyncIOMotorCollection = Depends(get_file_collection)
+    files: AsyncIOMotorCollection = Depends(get_file_collection),
+    users: AsyncIOMotorCollection = Depends(get_user_collection)
 ):
     from bson import ObjectId
     try:
@@ -257,6 +610,7 @@ async def rename_file(
         {"_id": obj_id},
         {"$set": {"filename": request.new_filename}}
     )
+    await bump_files_version(users, current_user.id)
 
     # Get the updated document
     updated_file = await files.find_one({"_id": obj_id})
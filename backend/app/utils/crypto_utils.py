@@ -1,29 +1,310 @@
+import os
+import json
+import time
 import zlib
 import base64
+import hmac
+import hashlib
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 from ..config import settings
 import aiofiles
 
-MASTER_KEY = base64.b64decode(settings.master_key_base64)
+# --- ENVELOPE ENCRYPTION ---
+# Every file gets its own random data key. The data key is "wrapped"
+# (encrypted) by a key-encryption key (KEK) from a KeyProvider and stored
+# next to the file metadata as:
+#
+#     {"kek_id": "...", "wrapped_key": "<base64>"}
+#
+# Rotating the KEK only means rewrapping these small envelopes; the
+# encrypted object bodies never have to be touched.
 
-def encrypt_data(data: bytes) -> bytes:
+DATA_KEY_SIZE = 32  # AES-256
+
+
+class KeyProvider(ABC):
+    """Wraps and unwraps data keys with a key-encryption key."""
+
+    @abstractmethod
+    def active_kek_id(self) -> str:
+        ...
+
+    @abstractmethod
+    def wrap(self, data_key: bytes) -> Tuple[str, bytes]:
+        """Wraps a data key with the active KEK. Returns (kek_id, wrapped_key)."""
+
+    @abstractmethod
+    def unwrap(self, kek_id: str, wrapped_key: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def rotate(self) -> str:
+        """Creates a new KEK, makes it active and returns its id."""
+
+
+class LocalKeyProvider(KeyProvider):
+    """
+    Keeps KEKs in a local JSON keyring:
+
+        {"active": "<kek_id>", "keys": {"<kek_id>": "<base64 key>", ...}}
+
+    Old KEKs stay in the keyring after rotation so existing envelopes can
+    still be unwrapped until they have been rewrapped.
+
+    The keyring is shared by every API worker and the admin CLI, so it is
+    re-read whenever the file changes on disk (checked before wrapping) or
+    an unknown kek_id shows up.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._keys: Dict[str, bytes] = {}
+        self._active: Optional[str] = None
+        self._file_id = None
+        if not os.path.exists(path):
+            self._create()
+        self._reload()
+
+    @staticmethod
+    def _new_kek_id() -> str:
+        return f"local-{int(time.time())}-{get_random_bytes(4).hex()}"
+
+    def _write_tmp(self, keyring: dict) -> str:
+        # Unique name so concurrent writers never share a temp file
+        tmp_path = f"{self.path}.{os.getpid()}.{get_random_bytes(4).hex()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(keyring, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp_path
+
+    def _create(self):
+        # Several workers may start at once without a keyring. Each writes a
+        # complete candidate and tries to link it into place; link() fails if
+        # the path exists, so exactly one wins and the others load its keys.
+        kek_id = self._new_kek_id()
+        keyring = {
+            "active": kek_id,
+            "keys": {kek_id: base64.b64encode(get_random_bytes(DATA_KEY_SIZE)).decode("utf-8")}
+        }
+        tmp_path = self._write_tmp(keyring)
+        try:
+            os.link(tmp_path, self.path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    def _reload(self):
+        with open(self.path, "r") as f:
+            st = os.fstat(f.fileno())
+            keyring = json.load(f)
+        self._keys = {k: base64.b64decode(v) for k, v in keyring["keys"].items()}
+        self._active = keyring["active"]
+        self._file_id = (st.st_ino, st.st_mtime_ns)
+
+    def _reload_if_changed(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (st.st_ino, st.st_mtime_ns) != self._file_id:
+            self._reload()
+
+    def _save(self):
+        keyring = {
+            "active": self._active,
+            "keys": {k: base64.b64encode(v).decode("utf-8") for k, v in self._keys.items()}
+        }
+        os.replace(self._write_tmp(keyring), self.path)
+
+    def active_kek_id(self) -> str:
+        with self._lock:
+            self._reload_if_changed()
+            return self._active
+
+    def wrap(self, data_key: bytes) -> Tuple[str, bytes]:
+        with self._lock:
+            # Pick up a rotation done by another process
+            self._reload_if_changed()
+            kek_id = self._active
+            kek = self._keys[kek_id]
+        nonce = get_random_bytes(12)
+        cipher = AES.new(kek, AES.MODE_GCM, nonce=nonce)
+        # Bind the wrapped key to the KEK that produced it
+        cipher.update(kek_id.encode("utf-8"))
+        wrapped, tag = cipher.encrypt_and_digest(data_key)
+        return kek_id, nonce + tag + wrapped
+
+    def unwrap(self, kek_id: str, wrapped_key: bytes) -> bytes:
+        with self._lock:
+            kek = self._keys.get(kek_id)
+            if kek is None:
+                # Possibly created by a rotation in another process
+                self._reload()
+                kek = self._keys.get(kek_id)
+        if kek is None:
+            raise ValueError(f"Unknown key-encryption key: {kek_id}")
+        nonce, tag, wrapped = wrapped_key[:12], wrapped_key[12:28], wrapped_key[28:]
+        cipher = AES.new(kek, AES.MODE_GCM, nonce=nonce)
+        cipher.update(kek_id.encode("utf-8"))
+        try:
+            return cipher.decrypt_and_verify(wrapped, tag)
+        except (ValueError, KeyError):
+            raise ValueError("Could not unwrap data key. Envelope may be corrupt or tampered with.")
+
+    def rotate(self) -> str:
+        with self._lock:
+            # Start from what's on disk so no other process's keys get dropped
+            self._reload()
+            kek_id = self._new_kek_id()
+            self._keys[kek_id] = get_random_bytes(DATA_KEY_SIZE)
+            self._active = kek_id
+            self._save()
+            self._reload()
+        return kek_id
+
+
+class DataKeyCache:
+    """
+    Bounded LRU cache of unwrapped data keys with a TTL, so hot files don't
+    need a provider round-trip on every request.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, bytes], Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kek_id: str, wrapped_key: bytes) -> Optional[bytes]:
+        cache_key = (kek_id, wrapped_key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            expires_at, data_key = entry
+            if expires_at < time.monotonic():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return data_key
+
+    def put(self, kek_id: str, wrapped_key: bytes, data_key: bytes):
+        cache_key = (kek_id, wrapped_key)
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + self.ttl, data_key)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _create_provider() -> KeyProvider:
+    if settings.kek_provider == "local":
+        return LocalKeyProvider(settings.local_kek_path)
+    raise ValueError(f"Unsupported KEK provider: {settings.kek_provider}")
+
+_provider: Optional[KeyProvider] = None
+data_key_cache = DataKeyCache(settings.data_key_cache_size, settings.data_key_cache_ttl)
+
+def get_key_provider() -> KeyProvider:
+    global _provider
+    if _provider is None:
+        _provider = _create_provider()
+    return _provider
+
+
+def generate_data_key(provider: Optional[KeyProvider] = None) -> Tuple[bytes, dict]:
+    """Creates a new data key. Returns (data_key, envelope to store in metadata)."""
+    provider = provider or get_key_provider()
+    data_key = get_random_bytes(DATA_KEY_SIZE)
+    kek_id, wrapped = provider.wrap(data_key)
+    data_key_cache.put(kek_id, wrapped, data_key)
+    return data_key, {"kek_id": kek_id, "wrapped_key": base64.b64encode(wrapped).decode("utf-8")}
+
+def unwrap_data_key(envelope: dict, provider: Optional[KeyProvider] = None) -> bytes:
+    """Returns the plaintext data key for an envelope, using the cache when possible."""
+    kek_id = envelope["kek_id"]
+    wrapped = base64.b64decode(envelope["wrapped_key"])
+    data_key = data_key_cache.get(kek_id, wrapped)
+    if data_key is None:
+        data_key = (provider or get_key_provider()).unwrap(kek_id, wrapped)
+        data_key_cache.put(kek_id, wrapped, data_key)
+    return data_key
+
+def rewrap_envelope(envelope: dict, provider: Optional[KeyProvider] = None) -> dict:
+    """Rewraps an envelope's data key under the active KEK."""
+    provider = provider or get_key_provider()
+    data_key = unwrap_data_key(envelope, provider)
+    kek_id, wrapped = provider.wrap(data_key)
+    # Keep any other envelope fields (e.g. "format") as they are
+    return {**envelope, "kek_id": kek_id, "wrapped_key": base64.b64encode(wrapped).decode("utf-8")}
+
+async def rotate_kek(*collections, provider: Optional[KeyProvider] = None) -> int:
+    """
+    Creates a new active KEK and rewraps every stored envelope under it.
+    Only the `encryption` field of documents in the given collections
+    (file metadata, deduplicated blobs) is rewritten.
+    Returns the number of documents rewrapped.
+    """
+    provider = provider or get_key_provider()
+    new_kek_id = provider.rotate()
+    rewrapped = 0
+    for collection in collections:
+        cursor = collection.find(
+            {"encryption": {"$exists": True}, "encryption.kek_id": {"$ne": new_kek_id}},
+            {"encryption": 1}
+        )
+        async for doc in cursor:
+            new_envelope = rewrap_envelope(doc["encryption"], provider)
+            # Conditional update so a concurrent rewrap doesn't get clobbered
+            result = await collection.update_one(
+                {"_id": doc["_id"], "encryption": doc["encryption"]},
+                {"$set": {"encryption": new_envelope}}
+            )
+            rewrapped += result.modified_count
+    return rewrapped
+
+
+def content_hasher():
+    """
+    Keyed hash (HMAC-SHA256) of plaintext, used to find duplicate uploads.
+    Being keyed, the stored hashes can't be used to test whether someone
+    holds a given file without also knowing the server secret.
+    """
+    dedup_key = hmac.new(settings.secret_key.encode("utf-8"), b"cryptocloud-dedup", hashlib.sha256).digest()
+    return hmac.new(dedup_key, digestmod=hashlib.sha256)
+
+
+def encrypt_data(data: bytes, data_key: bytes) -> bytes:
     """Compresses and then encrypts data using AES-GCM."""
     compressed_data = zlib.compress(data)
-    
+
     nonce = get_random_bytes(12)
-    cipher = AES.new(MASTER_KEY, AES.MODE_GCM, nonce=nonce)
+    cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
     ciphertext, tag = cipher.encrypt_and_digest(compressed_data)
-    
+
     return nonce + tag + ciphertext
 
-def decrypt_data(encrypted_data: bytes) -> bytes:
+def decrypt_data(encrypted_data: bytes, data_key: bytes) -> bytes:
     """Decrypts and then decompresses data."""
     nonce = encrypted_data[:12]
     tag = encrypted_data[12:28]
     ciphertext = encrypted_data[28:]
-    
-    cipher = AES.new(MASTER_KEY, AES.MODE_GCM, nonce=nonce)
+
+    cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
     try:
         decrypted_data = cipher.decrypt_and_verify(ciphertext, tag)
         return zlib.decompress(decrypted_data)
@@ -31,22 +312,117 @@ def decrypt_data(encrypted_data: bytes) -> bytes:
         # Handle decryption/verification errors
         raise ValueError("Decryption failed. Data may be corrupt or tampered with.")
 
-async def encrypt_file(input_path: str, output_path: str):
-    """Reads a file, encrypts its content, and writes to a new file."""
+async def encrypt_file(input_path: str, output_path: str) -> dict:
+    """
+    Reads a file, encrypts its content with a new data key, and writes to a new file.
+    Returns the envelope to store in the file's metadata.
+    """
     async with aiofiles.open(input_path, 'rb') as f:
         plaintext = await f.read()
-    
-    encrypted_content = encrypt_data(plaintext)
-    
+
+    data_key, envelope = generate_data_key()
+    encrypted_content = encrypt_data(plaintext, data_key)
+
     async with aiofiles.open(output_path, 'wb') as f:
         await f.write(encrypted_content)
+    return envelope
 
-async def decrypt_file(input_path: str, output_path: str):
+async def decrypt_file(input_path: str, output_path: str, envelope: dict):
     """Reads an encrypted file, decrypts its content, and writes to a new file."""
     async with aiofiles.open(input_path, 'rb') as f:
         encrypted_content = await f.read()
-    
-    decrypted_content = decrypt_data(encrypted_content)
-    
+
+    decrypted_content = decrypt_data(encrypted_content, unwrap_data_key(envelope))
+
     async with aiofiles.open(output_path, 'wb') as f:
         await f.write(decrypted_content)
+
+
+# --- CHUNKED (STREAMING) ENCRYPTION ---
+# Large uploads are encrypted in fixed-size plaintext chunks so memory stays
+# constant. Each chunk becomes one frame:
+#
+#     [4-byte big-endian length][1-byte final flag][nonce | tag | ciphertext]
+#
+# The chunk index and the final flag are authenticated with each frame, so
+# frames can't be reordered, dropped or the stream truncated unnoticed.
+# Envelopes for files written this way carry "format": STREAM_FORMAT.
+
+STREAM_FORMAT = "stream-v1"
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1 MiB of plaintext per frame
+_FRAME_HEADER = struct.Struct(">IB")
+
+def _frame_aad(index: int, final: bool) -> bytes:
+    return struct.pack(">QB", index, 1 if final else 0)
+
+class StreamEncryptor:
+    """Incrementally encrypts a byte stream into authenticated frames."""
+
+    def __init__(self, data_key: bytes, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.data_key = data_key
+        self.chunk_size = chunk_size
+        self._index = 0
+        self._buffer = bytearray()
+
+    def _frame(self, chunk: bytes, final: bool) -> bytes:
+        nonce = get_random_bytes(12)
+        cipher = AES.new(self.data_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(_frame_aad(self._index, final))
+        ciphertext, tag = cipher.encrypt_and_digest(zlib.compress(chunk))
+        self._index += 1
+        body = nonce + tag + ciphertext
+        return _FRAME_HEADER.pack(len(body), 1 if final else 0) + body
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        out = bytearray()
+        # Always keep at least one byte back so finalize() has a frame to mark final
+        while len(self._buffer) > self.chunk_size:
+            out += self._frame(bytes(self._buffer[:self.chunk_size]), final=False)
+            del self._buffer[:self.chunk_size]
+        return bytes(out)
+
+    def finalize(self) -> bytes:
+        out = self._frame(bytes(self._buffer), final=True)
+        self._buffer.clear()
+        return out
+
+class StreamDecryptor:
+    """Incrementally decrypts frames produced by StreamEncryptor."""
+
+    def __init__(self, data_key: bytes):
+        self.data_key = data_key
+        self._index = 0
+        self._buffer = bytearray()
+        self._finished = False
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        out = bytearray()
+        while len(self._buffer) >= _FRAME_HEADER.size:
+            length, final = _FRAME_HEADER.unpack_from(self._buffer)
+            end = _FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            if self._finished:
+                raise ValueError("Decryption failed. Data found after the final frame.")
+            body = bytes(self._buffer[_FRAME_HEADER.size:end])
+            del self._buffer[:end]
+            out += self._decrypt_frame(body, bool(final))
+        return bytes(out)
+
+    def _decrypt_frame(self, body: bytes, final: bool) -> bytes:
+        nonce, tag, ciphertext = body[:12], body[12:28], body[28:]
+        cipher = AES.new(self.data_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(_frame_aad(self._index, final))
+        try:
+            compressed = cipher.decrypt_and_verify(ciphertext, tag)
+        except (ValueError, KeyError):
+            raise ValueError("Decryption failed. Data may be corrupt or tampered with.")
+        self._index += 1
+        self._finished = final
+        return zlib.decompress(compressed)
+
+    def finalize(self):
+        if self._buffer or not self._finished:
+            raise ValueError("Decryption failed. Encrypted stream is truncated.")
@@ -0,0 +1,104 @@
+from typing import Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+# --- CONTENT-ADDRESSED BLOBS ---
+# Server-side encrypted uploads are deduplicated by a keyed hash of their
+# plaintext. Each distinct content is stored once, as a document in the
+# `blobs` collection:
+#
+#     {"_id": <content hash>, "s3_key": ..., "size": <plaintext bytes>,
+#      "encryption": <envelope>, "refcount": <number of files using it>}
+#
+# File metadata points at the blob through `content_hash` and carries a
+# copy of its `file_path` and `encryption`. The S3 object is only deleted
+# once the last file referencing it is gone.
+
+
+async def claim_blob(
+    blobs: AsyncIOMotorCollection,
+    content_hash: str,
+    s3_key: str,
+    size: int,
+    encryption: dict
+) -> Tuple[dict, bool]:
+    """
+    Registers one more reference to the content `content_hash`.
+
+    `s3_key`/`encryption` describe the object that was just uploaded. If the
+    content already exists, the existing blob is returned and the caller
+    should delete its own upload. Returns (blob, is_new).
+    """
+    while True:
+        # This may revive a blob whose refcount just hit zero. That's safe:
+        # release_blob only deletes the S3 object after removing the document,
+        # and it won't remove it once the refcount is back above zero.
+        existing = await blobs.find_one_and_update(
+            {"_id": content_hash},
+            {"$inc": {"refcount": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if existing is not None:
+            return existing, False
+
+        blob = {
+            "_id": content_hash,
+            "s3_key": s3_key,
+            "size": size,
+            "encryption": encryption,
+            "refcount": 1
+        }
+        try:
+            await blobs.insert_one(blob)
+            return blob, True
+        except DuplicateKeyError:
+            # Someone else uploaded the same content at the same time
+            continue
+
+
+async def release_blob(blobs: AsyncIOMotorCollection, content_hash: str) -> Optional[str]:
+    """
+    Drops one reference to a blob. Returns the S3 key to delete if that was
+    the last reference, otherwise None.
+    """
+    blob = await blobs.find_one_and_update(
+        {"_id": content_hash},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None or blob["refcount"] > 0:
+        return None
+
+    # Only remove it if nobody claimed it in the meantime
+    result = await blobs.delete_one({"_id": content_hash, "refcount": {"$lte": 0}})
+    if result.deleted_count == 0:
+        return None
+    return blob["s3_key"]
+
+
+async def dedup_stats(blobs: AsyncIOMotorCollection) -> dict:
+    """Bytes referenced by files vs. bytes actually stored."""
+    pipeline = [
+        {"$match": {"refcount": {"$gt": 0}}},
+        {"$group": {
+            "_id": None,
+            "blobs": {"$sum": 1},
+            "references": {"$sum": "$refcount"},
+            "stored_bytes": {"$sum": "$size"},
+            "logical_bytes": {"$sum": {"$multiply": ["$size", "$refcount"]}}
+        }}
+    ]
+    result = await blobs.aggregate(pipeline).to_list(length=1)
+    totals = result[0] if result else {}
+    stored = totals.get("stored_bytes", 0)
+    logical = totals.get("logical_bytes", 0)
+    return {
+        "blobs": totals.get("blobs", 0),
+        "references": totals.get("references", 0),
+        "stored_bytes": stored,
+        "logical_bytes": logical,
+        "saved_bytes": logical - stored,
+        "savings_ratio": (logical - stored) / logical if logical else 0.0
+    }
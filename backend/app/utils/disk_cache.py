@@ -0,0 +1,181 @@
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import BinaryIO, Callable, Dict, Tuple
+
+from ..config import settings
+
+# Temp files untouched for this long belong to a fetch that died with its
+# worker. Live fetches keep writing, so their mtime stays fresh.
+STALE_TMP_SECONDS = 3600
+
+
+class DiskObjectCache:
+    """
+    Size-bounded LRU cache of S3 objects on local disk.
+
+    Entries are keyed by S3 key and ETag, so a changed object never serves
+    stale bytes. Concurrent misses for the same entry share a single fetch.
+    All bookkeeping happens on the event loop; only the fetch itself runs
+    in a worker thread.
+
+    Callers get an already-open file rather than a path, so an entry that
+    is evicted or invalidated while a response is still being sent stays
+    readable until the caller closes it.
+
+    Several worker processes may share the directory. Each fetch writes to
+    its own temp file and publishes it with an atomic rename, so workers
+    never see each other's partial downloads. The byte budget is tracked
+    per process, though: with N workers the directory can hold up to about
+    N * max_bytes.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        # Objects bigger than this bypass the cache so one huge file can't flush it
+        self.max_entry_bytes = max_bytes // 8
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # name -> size, LRU first
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served_from_cache = 0
+        self.bytes_fetched = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # Rebuild the index from what's already on disk, oldest access first
+        found = []
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                st = os.stat(path)
+                if name.endswith(".tmp"):
+                    # Other workers may still be writing theirs
+                    if now - st.st_mtime > STALE_TMP_SECONDS:
+                        os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue  # removed by another worker meanwhile
+            found.append((st.st_atime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def _key_prefix(s3_key: str) -> str:
+        return hashlib.sha256(s3_key.encode("utf-8")).hexdigest()
+
+    def _name(self, s3_key: str, etag: str) -> str:
+        etag_hash = hashlib.sha256(etag.encode("utf-8")).hexdigest()[:16]
+        return f"{self._key_prefix(s3_key)}-{etag_hash}"
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    async def open_or_fetch(self, s3_key: str, etag: str, fetch: Callable[[str], None]) -> Tuple[BinaryIO, int]:
+        """
+        Returns (open file, size) for the cached object, calling
+        `fetch(tmp_path)` in a worker thread to download it on a miss.
+        The caller must close the file.
+        """
+        name = self._name(s3_key, etag)
+        missed = False
+        while True:
+            # No await between the lookup and open(), so nothing on the
+            # event loop can evict the entry in between.
+            size = self._entries.get(name)
+            if size is not None:
+                try:
+                    f = open(self._path(name), "rb")
+                except FileNotFoundError:
+                    self.total_bytes -= self._entries.pop(name)
+                else:
+                    self._entries.move_to_end(name)
+                    if not missed:
+                        self.hits += 1
+                        self.bytes_served_from_cache += size
+                    return f, size
+
+            if not missed:
+                self.misses += 1
+                missed = True
+            fill = self._inflight.get(name)
+            if fill is None:
+                fill = asyncio.ensure_future(self._fill(name, fetch))
+                self._inflight[name] = fill
+                fill.add_done_callback(lambda _: self._inflight.pop(name, None))
+            # Shield so one client going away doesn't cancel the fetch for the rest
+            await asyncio.shield(fill)
+
+    async def _fill(self, name: str, fetch: Callable[[str], None]) -> int:
+        path = self._path(name)
+        # Unique per fetch: other workers may be filling the same entry
+        tmp_path = f"{path}.{os.getpid()}.{os.urandom(4).hex()}.tmp"
+        try:
+            await asyncio.to_thread(fetch, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        size = os.path.getsize(path)
+        self.bytes_fetched += size
+        old_size = self._entries.pop(name, None)
+        if old_size is not None:
+            self.total_bytes -= old_size
+        self._entries[name] = size
+        self.total_bytes += size
+        self._evict()
+        return size
+
+    def _evict(self):
+        # Never evict the most recent entry; oversized objects are kept out by the caller
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def should_cache(self, size: int) -> bool:
+        return size <= self.max_entry_bytes
+
+    def invalidate(self, s3_key: str):
+        """Drops every cached version of an S3 object."""
+        prefix = self._key_prefix(s3_key)
+        for name in [n for n in self._entries if n.startswith(prefix)]:
+            self.total_bytes -= self._entries.pop(name)
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_served_from_cache": self.bytes_served_from_cache,
+            "bytes_fetched": self.bytes_fetched,
+            "entries": len(self._entries),
+            "size_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+
+_download_cache = None
+
+def get_download_cache() -> DiskObjectCache:
+    global _download_cache
+    if _download_cache is None:
+        _download_cache = DiskObjectCache(settings.download_cache_dir, settings.download_cache_max_bytes)
+    return _download_cache
@@ -0,0 +1,298 @@
+import asyncio
+import json
+from typing import Dict, Optional, Set
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from ..models.file_model import FileMetadataResponse
+from ..db import get_file_collection, get_user_collection
+
+# How many undelivered events a single client may have before we consider it
+# too slow. Instead of growing without bound we drop its backlog and send a
+# single "resync" event telling it to re-fetch the listing.
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Fallback polling interval for stand-alone MongoDB (no change streams).
+POLL_INTERVAL_SECONDS = 2.0
+
+# How long to wait before restarting a change stream that failed.
+RESTART_DELAY_SECONDS = 1.0
+
+# Error codes Mongo returns when change streams are not available
+# (40573: not a replica set, 40324: unrecognized pipeline stage on old servers).
+CHANGE_STREAM_UNSUPPORTED = {40573, 40324}
+
+
+def _file_to_dict(f: dict) -> dict:
+    return FileMetadataResponse(
+        id=str(f["_id"]),
+        filename=f["filename"],
+        owner_id=str(f["owner_id"]),
+        upload_time=f["upload_time"].isoformat(),
+        file_size=f.get("file_size", 0)
+    ).model_dump()
+
+
+class FileEventBroker:
+    """
+    Fans out per-user file events (insert, rename, delete) to SSE subscribers.
+
+    A single watcher task reads the files collection's change stream and
+    pushes events into bounded per-subscriber queues. On MongoDB < 6.0,
+    where delete events can't be routed to their owner, it also watches
+    `files_version` bumps on users and sends those users a resync. When the
+    server is a stand-alone mongod the watcher falls back to polling the
+    `files_version` counter of subscribed users and diffing their file set.
+    """
+
+    def __init__(self, files: AsyncIOMotorCollection, users: AsyncIOMotorCollection,
+                 queue_size: int = SUBSCRIBER_QUEUE_SIZE,
+                 poll_interval: float = POLL_INTERVAL_SECONDS,
+                 restart_delay: float = RESTART_DELAY_SECONDS):
+        self.files = files
+        self.users = users
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.restart_delay = restart_delay
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._resume_token = None
+        self._users_resume_token = None
+
+    # --- Subscription management ---
+    def subscribe(self, user_id) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(str(user_id), set()).add(queue)
+        self._ensure_started()
+        return queue
+
+    def unsubscribe(self, user_id, queue: asyncio.Queue):
+        queues = self._subscribers.get(str(user_id))
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[str(user_id)]
+
+    def publish(self, user_id, event: dict):
+        for queue in list(self._subscribers.get(str(user_id), ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Backpressure: the client is not keeping up. Drop what it
+                # hasn't read yet and tell it to reload from the API instead.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+    def _resync_all(self):
+        for user_id in list(self._subscribers):
+            for queue in list(self._subscribers.get(user_id, ())):
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+    # --- Watcher lifecycle ---
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self._watch_change_stream()
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED:
+                    print("Change streams unavailable, falling back to polling for file events")
+                    try:
+                        await self._poll()
+                    except Exception as poll_error:
+                        print(f"File event polling crashed, restarting: {poll_error!r}")
+                else:
+                    # e.g. ChangeStreamHistoryLost (286): the resume token is useless now
+                    print(f"File change stream failed, restarting: {e}")
+            except Exception as e:
+                print(f"File event watcher crashed, restarting: {e!r}")
+
+            # Events may have been missed. Start from "now" and have every
+            # client reload its listing instead.
+            self._resume_token = None
+            self._users_resume_token = None
+            self._resync_all()
+            await asyncio.sleep(self.restart_delay)
+
+    async def _enable_pre_images(self) -> bool:
+        # Delete events need the pre-image to know which user to notify.
+        # Pre-images only exist on MongoDB 6.0+; older servers reject the
+        # option outright, so only ask for them when the server has them.
+        try:
+            build_info = await self.files.database.command("buildInfo")
+            if build_info.get("versionArray", [0])[0] < 6:
+                print("MongoDB < 6.0: file deletions will be sent as resync events")
+                return False
+            await self.files.database.command(
+                "collMod", self.files.name,
+                changeStreamPreAndPostImages={"enabled": True}
+            )
+            return True
+        except PyMongoError as e:
+            print(f"Could not enable change stream pre-images on files: {e}")
+            return False
+
+    async def _watch_change_stream(self):
+        files_options = {"full_document": "updateLookup"}
+        pre_images = await self._enable_pre_images()
+        if pre_images:
+            files_options["full_document_before_change"] = "whenAvailable"
+        watchers = [
+            self._watch(
+                self.files,
+                [{"$match": {"operationType": {"$in": ["insert", "update", "delete"]}}}],
+                "_resume_token", self._dispatch, **files_options
+            )
+        ]
+        if not pre_images:
+            # Without pre-images a delete event doesn't say whose file it was.
+            # Every delete also bumps the owner's files_version, so watch for
+            # that instead and have the owner's clients reload.
+            watchers.append(self._watch(
+                self.users,
+                [{"$match": {
+                    "operationType": "update",
+                    "updateDescription.updatedFields.files_version": {"$exists": True}
+                }}],
+                "_users_resume_token", self._dispatch_user_change
+            ))
+
+        tasks = [asyncio.create_task(watcher) for watcher in watchers]
+        try:
+            # Whichever stream fails first takes the other one down with it
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _watch(self, collection: AsyncIOMotorCollection, pipeline: list,
+                     token_attr: str, dispatch, **watch_options):
+        while True:
+            try:
+                async with collection.watch(
+                    pipeline,
+                    resume_after=getattr(self, token_attr),
+                    **watch_options
+                ) as stream:
+                    async for change in stream:
+                        setattr(self, token_attr, stream.resume_token)
+                        try:
+                            dispatch(change)
+                        except Exception as e:
+                            # One malformed document must not take the feed down
+                            print(f"Could not dispatch {collection.name} change {change.get('_id')}: {e!r}")
+            except OperationFailure:
+                raise
+            except PyMongoError as e:
+                # Network blip or primary stepdown: resume from the last token
+                print(f"{collection.name} change stream interrupted, resuming: {e}")
+                await asyncio.sleep(1)
+
+    def _dispatch(self, change: dict):
+        op = change["operationType"]
+        if op == "insert":
+            doc = change["fullDocument"]
+            self.publish(doc["owner_id"], {"type": "insert", "file": _file_to_dict(doc)})
+        elif op == "update":
+            updated = change.get("updateDescription", {}).get("updatedFields", {})
+            doc = change.get("fullDocument")
+            if "filename" in updated and doc is not None:
+                self.publish(doc["owner_id"], {
+                    "type": "rename",
+                    "file": {"id": str(doc["_id"]), "filename": updated["filename"]}
+                })
+        elif op == "delete":
+            # Delete events only carry the _id, so the owner comes from the
+            # pre-image. Without pre-images, _dispatch_user_change covers it.
+            before = change.get("fullDocumentBeforeChange")
+            if before is not None:
+                self.publish(before["owner_id"], {
+                    "type": "delete",
+                    "file": {"id": str(change["documentKey"]["_id"])}
+                })
+
+    def _dispatch_user_change(self, change: dict):
+        self.publish(change["documentKey"]["_id"], {"type": "resync"})
+
+    async def _poll(self):
+        versions: Dict[str, int] = {}
+        snapshots: Dict[str, Dict[str, dict]] = {}
+        while True:
+            user_ids = list(self._subscribers.keys())
+            # Forget users that no longer have any subscribers
+            for uid in list(versions):
+                if uid not in self._subscribers:
+                    versions.pop(uid, None)
+                    snapshots.pop(uid, None)
+
+            if user_ids:
+                cursor = self.users.find(
+                    {"_id": {"$in": [ObjectId(uid) for uid in user_ids]}},
+                    {"files_version": 1}
+                )
+                async for user_doc in cursor:
+                    uid = str(user_doc["_id"])
+                    version = user_doc.get("files_version", 0)
+                    if versions.get(uid) == version:
+                        continue
+                    current = {
+                        str(f["_id"]): f
+                        async for f in self.files.find({"owner_id": user_doc["_id"]})
+                    }
+                    if uid in snapshots:
+                        self._diff(uid, snapshots[uid], current)
+                    snapshots[uid] = current
+                    versions[uid] = version
+
+            await asyncio.sleep(self.poll_interval)
+
+    def _diff(self, user_id: str, before: Dict[str, dict], after: Dict[str, dict]):
+        for file_id, doc in after.items():
+            old = before.get(file_id)
+            if old is None:
+                self.publish(user_id, {"type": "insert", "file": _file_to_dict(doc)})
+            elif old["filename"] != doc["filename"]:
+                self.publish(user_id, {
+                    "type": "rename",
+                    "file": {"id": file_id, "filename": doc["filename"]}
+                })
+        for file_id in before.keys() - after.keys():
+            self.publish(user_id, {"type": "delete", "file": {"id": file_id}})
+
+
+def format_sse(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+_broker: Optional[FileEventBroker] = None
+
+def get_file_event_broker() -> FileEventBroker:
+    global _broker
+    if _broker is None:
+        _broker = FileEventBroker(get_file_collection(), get_user_collection())
+    return _broker
+
+async def close_file_event_broker():
+    if _broker is not None:
+        await _broker.close()
@@ -0,0 +1,104 @@
+import asyncio
+from typing import AsyncIterator, List
+
+# S3 requires every part except the last to be at least 5 MiB.
+PART_SIZE = 8 * 1024 * 1024
+# At most this many parts are uploading at once. Together with PART_SIZE
+# this caps the memory a single upload can hold, regardless of file size.
+MAX_IN_FLIGHT_PARTS = 4
+
+
+async def stream_to_s3(
+    s3_client,
+    bucket: str,
+    key: str,
+    chunks: AsyncIterator[bytes],
+    content_type: str = "application/octet-stream",
+    encryptor=None,
+    part_size: int = PART_SIZE,
+    max_in_flight: int = MAX_IN_FLIGHT_PARTS
+) -> int:
+    """
+    Pipes an async byte stream into an S3 multipart upload.
+
+    If `encryptor` is given (see crypto_utils.StreamEncryptor), the data is
+    encrypted chunk by chunk before being uploaded. Compression and
+    encryption run in a worker thread, a frame's worth of input at a time,
+    so they don't stall the event loop. Returns the number of plaintext
+    bytes read from `chunks`. On any failure the multipart upload is
+    aborted so no orphaned parts are left behind.
+    """
+    upload = await asyncio.to_thread(
+        s3_client.create_multipart_upload,
+        Bucket=bucket, Key=key, ContentType=content_type
+    )
+    upload_id = upload["UploadId"]
+
+    slots = asyncio.Semaphore(max_in_flight)
+    tasks: List[asyncio.Task] = []
+    buffer = bytearray()
+    plaintext = bytearray()  # not yet handed to the encryptor
+    bytes_read = 0
+
+    async def upload_part(part_number: int, body: bytes) -> dict:
+        try:
+            result = await asyncio.to_thread(
+                s3_client.upload_part,
+                Bucket=bucket, Key=key, UploadId=upload_id,
+                PartNumber=part_number, Body=body
+            )
+            return {"PartNumber": part_number, "ETag": result["ETag"]}
+        finally:
+            slots.release()
+
+    async def submit(body: bytes):
+        # Blocks (and so stops reading the request body) while all slots are busy
+        await slots.acquire()
+        for task in tasks:
+            if task.done() and task.exception() is not None:
+                slots.release()
+                raise task.exception()
+        tasks.append(asyncio.create_task(upload_part(len(tasks) + 1, body)))
+
+    try:
+        async for chunk in chunks:
+            bytes_read += len(chunk)
+            if encryptor is None:
+                buffer += chunk
+            else:
+                plaintext += chunk
+                if len(plaintext) >= encryptor.chunk_size:
+                    buffer += await asyncio.to_thread(encryptor.update, bytes(plaintext))
+                    plaintext.clear()
+            while len(buffer) >= part_size:
+                await submit(bytes(buffer[:part_size]))
+                del buffer[:part_size]
+
+        if encryptor:
+            rest = bytes(plaintext)
+            buffer += await asyncio.to_thread(lambda: encryptor.update(rest) + encryptor.finalize())
+        # The last part may be smaller than part_size (or even empty)
+        if buffer or not tasks:
+            await submit(bytes(buffer))
+            buffer.clear()
+
+        parts = await asyncio.gather(*tasks)
+        await asyncio.to_thread(
+            s3_client.complete_multipart_upload,
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={"Parts": sorted(parts, key=lambda p: p["PartNumber"])}
+        )
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await asyncio.to_thread(
+                s3_client.abort_multipart_upload,
+                Bucket=bucket, Key=key, UploadId=upload_id
+            )
+        except Exception as e:
+            print(f"Could not abort multipart upload {upload_id} for {key}: {e}")
+        raise
+
+    return bytes_read
@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+# app.config.Settings requires these; the tests never talk to real services.
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("JWT_EXP", "3600")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+os.environ.setdefault("S3_BUCKET_NAME", "test-bucket")
+os.environ.setdefault("S3_REGION", "us-east-1")
+# Keep runtime state (keyring, download cache) out of the working tree
+_state_dir = tempfile.mkdtemp(prefix="cryptocloud-tests-")
+os.environ.setdefault("LOCAL_KEK_PATH", os.path.join(_state_dir, "kek.json"))
+os.environ.setdefault("DOWNLOAD_CACHE_DIR", os.path.join(_state_dir, "download_cache"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
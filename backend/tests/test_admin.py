@@ -0,0 +1,193 @@
+import asyncio
+import gzip
+import multiprocessing
+import os
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from app.admin import export_collection, import_collection, run_export
+
+
+# --- Local in-memory stand-in for a Mongo collection ---
+class StandInCursor:
+    def __init__(self, docs, on_yield=None):
+        self._docs = docs
+        self._on_yield = on_yield
+
+    def sort(self, field, direction):
+        self._docs = sorted(self._docs, key=lambda d: d[field], reverse=direction < 0)
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    async def __aiter__(self):
+        for i, doc in enumerate(self._docs):
+            if self._on_yield:
+                self._on_yield(i)
+            yield doc
+
+
+class StandInCollection:
+    def __init__(self, name, docs=(), on_yield=None):
+        self.name = name
+        self.docs = {d["_id"]: d for d in docs}
+        self.on_yield = on_yield
+        self.insert_calls = 0
+
+    def find(self, query):
+        docs = list(self.docs.values())
+        if "_id" in query:
+            docs = [d for d in docs if d["_id"] > query["_id"]["$gt"]]
+        return StandInCursor(docs, self.on_yield)
+
+    async def insert_many(self, docs, ordered=True):
+        self.insert_calls += 1
+        errors = []
+        for i, doc in enumerate(docs):
+            if doc["_id"] in self.docs:
+                errors.append({"index": i, "code": 11000})
+            else:
+                self.docs[doc["_id"]] = doc
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+def _make_docs(count):
+    return [
+        {"_id": ObjectId(), "filename": f"file-{i}.txt", "file_size": i, "upload_time": datetime(2024, 1, 1, 0, 0, i % 60)}
+        for i in range(count)
+    ]
+
+
+def _export_then_die(path, docs, die_after):
+    # Runs in a child process and dies without any cleanup, like kill -9
+    def on_yield(i):
+        if i == die_after:
+            os._exit(1)
+    collection = StandInCollection("files", docs, on_yield=on_yield)
+    asyncio.run(export_collection(collection, path, batch_size=10))
+
+
+def _round_trip(path):
+    target = StandInCollection("files")
+    result = asyncio.run(import_collection(target, path, batch_size=7))
+    return target, result
+
+
+def test_export_killed_mid_run_resumes_to_a_readable_file(tmp_path):
+    path = str(tmp_path / "files.ndjson.gz")
+    docs = _make_docs(95)
+
+    # Dies in the middle of the fourth batch, after three checkpoints
+    child = multiprocessing.get_context("fork").Process(target=_export_then_die, args=(path, docs, 35))
+    child.start()
+    child.join()
+    assert child.exitcode == 1
+
+    asyncio.run(export_collection(StandInCollection("files", docs), path, batch_size=10))
+
+    with gzip.open(path, "rt") as f:
+        assert sum(1 for _ in f) == 95
+    target, result = _round_trip(path)
+    assert result["rows"] == 95
+    assert result["rows_per_second"] > 0
+    assert target.docs == {d["_id"]: d for d in docs}
+
+
+def test_resume_discards_partial_member_after_checkpoint(tmp_path):
+    path = str(tmp_path / "files.ndjson.gz")
+    docs = _make_docs(30)
+
+    def lose_connection(i):
+        if i == 20:
+            raise ConnectionError("cursor died")
+    with pytest.raises(ConnectionError):
+        asyncio.run(export_collection(StandInCollection("files", docs, on_yield=lose_connection), path, batch_size=10))
+    # Simulate a kill halfway through writing the next member
+    with open(path, "ab") as f:
+        f.write(gzip.compress(b'{"half": ')[:15])
+
+    asyncio.run(export_collection(StandInCollection("files", docs), path, batch_size=10))
+
+    target, _ = _round_trip(path)
+    assert target.docs == {d["_id"]: d for d in docs}
+
+
+def test_import_is_idempotent(tmp_path):
+    path = str(tmp_path / "files.ndjson.gz")
+    docs = _make_docs(25)
+    asyncio.run(export_collection(StandInCollection("files", docs), path, batch_size=10, resume=False))
+
+    target = StandInCollection("files", docs[:12])
+    asyncio.run(import_collection(target, path, batch_size=10))
+
+    assert target.docs == {d["_id"]: d for d in docs}
+
+
+def test_import_surfaces_real_write_errors(tmp_path):
+    path = str(tmp_path / "files.ndjson.gz")
+    asyncio.run(export_collection(StandInCollection("files", _make_docs(3)), path, resume=False))
+
+    class Failing(StandInCollection):
+        async def insert_many(self, docs, ordered=True):
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": 121}]})
+
+    with pytest.raises(BulkWriteError):
+        asyncio.run(import_collection(Failing("files"), path))
+
+
+class StandInDatabase:
+    def __init__(self, **collections):
+        self.collections = collections
+
+    def get_collection(self, name):
+        return self.collections[name]
+
+
+def _read_export(path):
+    target, _ = _round_trip(path)
+    return target.docs
+
+
+def test_finished_export_is_not_resumed_by_the_next_run(tmp_path):
+    out_dir = str(tmp_path / "backup")
+    docs = _make_docs(25)
+    files = StandInCollection("files", docs)
+    asyncio.run(run_export(StandInDatabase(files=files), out_dir, ["files"], 10, resume=True))
+
+    # The data changes between two scheduled backups
+    files.docs[docs[0]["_id"]] = dict(docs[0], filename="updated.txt")
+    del files.docs[docs[1]["_id"]]
+    new_doc = _make_docs(1)[0]
+    files.docs[new_doc["_id"]] = new_doc
+
+    asyncio.run(run_export(StandInDatabase(files=files), out_dir, ["files"], 10, resume=True))
+
+    exported = _read_export(os.path.join(out_dir, "files.ndjson.gz"))
+    assert exported == files.docs
+    assert not os.path.exists(os.path.join(out_dir, "files.ndjson.gz.checkpoint"))
+
+
+def test_interrupted_run_skips_collections_it_already_finished(tmp_path):
+    out_dir = str(tmp_path / "backup")
+    users = StandInCollection("users", _make_docs(5))
+    file_docs = _make_docs(30)
+
+    def lose_connection(i):
+        if i == 15:
+            raise ConnectionError("cursor died")
+    failing_files = StandInCollection("files", file_docs, on_yield=lose_connection)
+    with pytest.raises(ConnectionError):
+        asyncio.run(run_export(StandInDatabase(users=users, files=failing_files), out_dir, ["users", "files"], 10, resume=True))
+
+    files = StandInCollection("files", file_docs)
+    results = asyncio.run(run_export(StandInDatabase(users=users, files=files), out_dir, ["users", "files"], 10, resume=True))
+
+    assert results["users"]["skipped"]
+    assert results["files"]["rows"] == 20
+    assert _read_export(os.path.join(out_dir, "users.ndjson.gz")) == users.docs
+    assert _read_export(os.path.join(out_dir, "files.ndjson.gz")) == files.docs
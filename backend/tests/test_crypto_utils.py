@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from app.utils.crypto_utils import KeyProvider, LocalKeyProvider
+
+
+def test_key_provider_is_abstract():
+    with pytest.raises(TypeError):
+        KeyProvider()
+
+
+def test_worker_picks_up_rotation_from_another_process(tmp_path):
+    path = str(tmp_path / "kek.json")
+    worker = LocalKeyProvider(path)
+    old_kek = worker.active_kek_id()
+    _, wrapped_before = worker.wrap(b"k" * 32)
+
+    # e.g. `python -m app.admin rotate-kek` running elsewhere
+    admin = LocalKeyProvider(path)
+    new_kek = admin.rotate()
+    new_kek_id, rewrapped = admin.wrap(b"d" * 32)
+
+    assert new_kek != old_kek
+    assert worker.unwrap(new_kek_id, rewrapped) == b"d" * 32
+    assert worker.unwrap(old_kek, wrapped_before) == b"k" * 32
+    assert worker.wrap(b"x" * 32)[0] == new_kek
+
+
+def test_concurrent_first_start_agrees_on_one_keyring(tmp_path):
+    path = str(tmp_path / "kek.json")
+    barrier = threading.Barrier(8)
+    providers = []
+
+    def start_worker():
+        barrier.wait()
+        providers.append(LocalKeyProvider(path))
+
+    threads = [threading.Thread(target=start_worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len({p.active_kek_id() for p in providers}) == 1
+    kek_id, wrapped = providers[0].wrap(b"s" * 32)
+    for p in providers[1:]:
+        assert p.unwrap(kek_id, wrapped) == b"s" * 32
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["kek.json"]
@@ -0,0 +1,118 @@
+import asyncio
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.utils.dedup import claim_blob, release_blob
+
+
+# --- Local in-memory stand-in for the blobs collection ---
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+class StandInBlobs:
+    """
+    Supports the operations dedup.py uses. `before_insert` and
+    `before_delete` let a test run a competing request at exactly the
+    point where a real race would interleave.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.before_insert = None
+        self.before_delete = None
+
+    async def find_one_and_update(self, query, update, return_document):
+        assert return_document == ReturnDocument.AFTER
+        doc = self.docs.get(query["_id"])
+        if doc is None:
+            return None
+        doc["refcount"] += update["$inc"]["refcount"]
+        return dict(doc)
+
+    async def insert_one(self, doc):
+        if self.before_insert:
+            hook, self.before_insert = self.before_insert, None
+            await hook()
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError("duplicate key")
+        self.docs[doc["_id"]] = dict(doc)
+
+    async def delete_one(self, query):
+        if self.before_delete:
+            hook, self.before_delete = self.before_delete, None
+            await hook()
+        doc = self.docs.get(query["_id"])
+        if doc is None or doc["refcount"] > query["refcount"]["$lte"]:
+            return DeleteResult(0)
+        del self.docs[query["_id"]]
+        return DeleteResult(1)
+
+
+ENVELOPE = {"kek_id": "k1", "wrapped_key": "AAAA"}
+
+
+def test_claim_and_release_track_references():
+    async def scenario():
+        blobs = StandInBlobs()
+        first, first_new = await claim_blob(blobs, "h", "blobs/one", 10, ENVELOPE)
+        second, second_new = await claim_blob(blobs, "h", "blobs/two", 10, ENVELOPE)
+        refcount = blobs.docs["h"]["refcount"]
+        released = [await release_blob(blobs, "h"), await release_blob(blobs, "h")]
+        return first, first_new, second, second_new, refcount, released, blobs
+
+    first, first_new, second, second_new, refcount, released, blobs = asyncio.run(scenario())
+    assert first_new and not second_new
+    # The duplicate points at the first upload's object, not its own
+    assert second["s3_key"] == "blobs/one"
+    assert refcount == 2
+    # Only the last release hands back the S3 key to delete
+    assert released == [None, "blobs/one"]
+    assert blobs.docs == {}
+
+
+def test_release_of_unknown_blob_deletes_nothing():
+    assert asyncio.run(release_blob(StandInBlobs(), "missing")) is None
+
+
+def test_claim_revives_blob_released_concurrently():
+    async def scenario():
+        blobs = StandInBlobs()
+        await claim_blob(blobs, "h", "blobs/one", 10, ENVELOPE)
+        revived = []
+
+        async def claim_in_between():
+            # The refcount has just dropped to zero but the document is still there
+            revived.append(await claim_blob(blobs, "h", "blobs/two", 10, ENVELOPE))
+
+        blobs.before_delete = claim_in_between
+        released = await release_blob(blobs, "h")
+        return released, revived, blobs
+
+    released, revived, blobs = asyncio.run(scenario())
+    (blob, is_new), = revived
+    assert not is_new and blob["s3_key"] == "blobs/one"
+    # The object is still referenced, so the release must not delete it
+    assert released is None
+    assert blobs.docs["h"]["refcount"] == 1
+
+
+def test_concurrent_first_uploads_share_one_blob():
+    async def scenario():
+        blobs = StandInBlobs()
+        other = []
+
+        async def insert_in_between():
+            other.append(await claim_blob(blobs, "h", "blobs/other", 10, ENVELOPE))
+
+        blobs.before_insert = insert_in_between
+        mine = await claim_blob(blobs, "h", "blobs/mine", 10, ENVELOPE)
+        return mine, other, blobs
+
+    (blob, is_new), [(other_blob, other_new)], blobs = asyncio.run(scenario())
+    assert other_new and other_blob["s3_key"] == "blobs/other"
+    # Losing the insert race retries and joins the winner's blob
+    assert not is_new and blob["s3_key"] == "blobs/other"
+    assert blobs.docs["h"]["refcount"] == 2
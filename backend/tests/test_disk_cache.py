@@ -0,0 +1,114 @@
+import asyncio
+import os
+import time
+
+from fastapi.responses import StreamingResponse
+
+from app.routes.file_routes import _content_disposition
+from app.utils.disk_cache import DiskObjectCache, STALE_TMP_SECONDS
+
+
+def _fetcher(content: bytes, calls: list, delay: float = 0.0):
+    def fetch(tmp_path):
+        calls.append(tmp_path)
+        time.sleep(delay)
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+    return fetch
+
+
+def test_concurrent_misses_share_one_fetch(tmp_path):
+    async def scenario():
+        cache = DiskObjectCache(str(tmp_path), max_bytes=10_000)
+        calls = []
+        results = await asyncio.gather(*[
+            cache.open_or_fetch("a", "etag", _fetcher(b"x" * 100, calls, delay=0.05))
+            for _ in range(10)
+        ])
+        for f, _ in results:
+            f.close()
+        return cache, calls, results
+
+    cache, calls, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(size == 100 for _, size in results)
+    assert cache.stats()["misses"] == 10
+
+
+def test_lru_eviction_and_stats(tmp_path):
+    async def scenario():
+        cache = DiskObjectCache(str(tmp_path), max_bytes=2500)
+        calls = []
+        for key in ["a", "b", "a", "c"]:  # "b" is least recently used when "c" arrives
+            f, _ = await cache.open_or_fetch(key, "etag", _fetcher(b"x" * 1000, calls))
+            f.close()
+        f, _ = await cache.open_or_fetch("b", "etag", _fetcher(b"x" * 1000, calls))
+        f.close()
+        return cache, calls
+
+    cache, calls = asyncio.run(scenario())
+    assert len(calls) == 4  # a, b, c, then b again
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["bytes_served_from_cache"] == 1000
+    assert stats["size_bytes"] <= 2500
+
+
+def test_open_file_survives_invalidation(tmp_path):
+    async def scenario():
+        cache = DiskObjectCache(str(tmp_path), max_bytes=10_000)
+        f, _ = await cache.open_or_fetch("a", "etag", _fetcher(b"payload", []))
+        cache.invalidate("a")
+        try:
+            return f.read(), cache.stats()["entries"]
+        finally:
+            f.close()
+
+    content, entries = asyncio.run(scenario())
+    assert content == b"payload"
+    assert entries == 0
+
+
+def test_content_disposition_handles_any_filename():
+    assert _content_disposition("report.pdf") == 'attachment; filename="report.pdf"'
+    for name in ["报告.pdf", 'say "hi".txt', "naïve.txt"]:
+        header = _content_disposition(name)
+        assert header.startswith("attachment; filename*=utf-8''")
+        # Starlette encodes header values as latin-1; this must not raise
+        StreamingResponse(iter([b""]), headers={"Content-Disposition": header})
+
+
+def test_concurrent_fills_use_separate_temp_files(tmp_path):
+    # Two workers sharing the directory are two independent cache instances
+    async def scenario():
+        first = DiskObjectCache(str(tmp_path), max_bytes=10_000)
+        second = DiskObjectCache(str(tmp_path), max_bytes=10_000)
+        calls = []
+        results = await asyncio.gather(
+            first.open_or_fetch("a", "etag", _fetcher(b"1" * 100, calls, delay=0.05)),
+            second.open_or_fetch("a", "etag", _fetcher(b"1" * 100, calls, delay=0.05)),
+        )
+        contents = []
+        for f, _ in results:
+            contents.append(f.read())
+            f.close()
+        return calls, contents
+
+    calls, contents = asyncio.run(scenario())
+    assert len(set(calls)) == 2
+    assert contents == [b"1" * 100, b"1" * 100]
+
+
+def test_startup_only_removes_stale_temp_files(tmp_path):
+    live = tmp_path / "entry.123.abcd.tmp"
+    stale = tmp_path / "entry.456.ef01.tmp"
+    live.write_bytes(b"in progress")
+    stale.write_bytes(b"abandoned")
+    old = time.time() - 2 * STALE_TMP_SECONDS
+    os.utime(stale, (old, old))
+
+    cache = DiskObjectCache(str(tmp_path), max_bytes=10_000)
+
+    assert live.exists()
+    assert not stale.exists()
+    assert cache.stats()["entries"] == 0
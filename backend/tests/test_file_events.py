@@ -0,0 +1,293 @@
+import asyncio
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+from app.utils.file_events import FileEventBroker
+
+
+# --- Local stand-in for the files collection and its change stream ---
+class StandInChangeStream:
+    def __init__(self, events: asyncio.Queue):
+        self._events = events
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._events.get()
+        if isinstance(item, BaseException):
+            raise item
+        self.resume_token = {"_data": str(item.get("_id"))}
+        return item
+
+
+class StandInDatabase:
+    def __init__(self, server_major: int):
+        self.server_major = server_major
+        self.commands = []
+
+    async def command(self, name, *args, **kwargs):
+        self.commands.append(name)
+        if name == "buildInfo":
+            return {"versionArray": [self.server_major, 0, 0, 0]}
+        return {"ok": 1}
+
+
+class StandInWatched:
+    """Emits whatever synthetic change events the test pushes with emit()."""
+
+    def __init__(self):
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.watch_calls = []
+
+    def watch(self, pipeline, **kwargs):
+        self.watch_calls.append(kwargs)
+        return StandInChangeStream(self.events)
+
+    def emit(self, event):
+        self.events.put_nowait(event)
+
+
+class StandInFiles(StandInWatched):
+    name = "files"
+
+    def __init__(self, server_major: int = 7):
+        super().__init__()
+        self.database = StandInDatabase(server_major)
+
+
+class StandInUsers(StandInWatched):
+    name = "users"
+
+
+def _file_doc(owner_id, filename="report.pdf", **extra):
+    doc = {
+        "_id": ObjectId(),
+        "filename": filename,
+        "owner_id": owner_id,
+        "upload_time": datetime(2024, 1, 1),
+        "file_size": 42
+    }
+    doc.update(extra)
+    return doc
+
+def insert_event(doc):
+    return {"_id": ObjectId(), "operationType": "insert", "fullDocument": doc, "documentKey": {"_id": doc["_id"]}}
+
+def update_event(doc, updated_fields):
+    return {
+        "_id": ObjectId(),
+        "operationType": "update",
+        "fullDocument": doc,
+        "documentKey": {"_id": doc["_id"]},
+        "updateDescription": {"updatedFields": updated_fields}
+    }
+
+def files_version_event(user_id, version):
+    return {
+        "_id": ObjectId(),
+        "operationType": "update",
+        "documentKey": {"_id": user_id},
+        "updateDescription": {"updatedFields": {"files_version": version}}
+    }
+
+def delete_event(doc, with_pre_image=True):
+    event = {"_id": ObjectId(), "operationType": "delete", "documentKey": {"_id": doc["_id"]}}
+    if with_pre_image:
+        event["fullDocumentBeforeChange"] = doc
+    return event
+
+
+async def _drain(queue: asyncio.Queue, count: int, timeout: float = 1.0):
+    return [await asyncio.wait_for(queue.get(), timeout) for _ in range(count)]
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_routes_insert_rename_delete_to_owner_only():
+    async def scenario():
+        files = StandInFiles()
+        broker = FileEventBroker(files, users=None)
+        alice, bob = ObjectId(), ObjectId()
+        alice_queue = broker.subscribe(alice)
+        bob_queue = broker.subscribe(bob)
+
+        doc = _file_doc(alice)
+        files.emit(insert_event(doc))
+        files.emit(update_event(dict(doc, filename="renamed.pdf"), {"filename": "renamed.pdf"}))
+        files.emit(update_event(doc, {"s3_etag": '"abc"'}))  # not a rename
+        files.emit(delete_event(doc))
+
+        events = await _drain(alice_queue, 3)
+        await _settle()
+        await broker.close()
+        return doc, events, bob_queue, files
+
+    doc, events, bob_queue, files = asyncio.run(scenario())
+    assert [e["type"] for e in events] == ["insert", "rename", "delete"]
+    assert events[0]["file"]["id"] == str(doc["_id"])
+    assert events[0]["file"]["filename"] == "report.pdf"
+    assert events[1]["file"] == {"id": str(doc["_id"]), "filename": "renamed.pdf"}
+    assert events[2]["file"] == {"id": str(doc["_id"])}
+    assert bob_queue.empty()
+    assert files.watch_calls[0]["full_document_before_change"] == "whenAvailable"
+
+
+def test_pre_images_not_requested_before_mongo_6():
+    async def scenario():
+        files = StandInFiles(server_major=5)
+        broker = FileEventBroker(files, StandInUsers())
+        queue = broker.subscribe(ObjectId())
+        await _settle()
+        await broker.close()
+        return files, queue
+
+    files, queue = asyncio.run(scenario())
+    assert "full_document_before_change" not in files.watch_calls[0]
+    assert "collMod" not in files.database.commands
+
+
+def test_deletes_reach_owner_as_resync_before_mongo_6():
+    async def scenario():
+        files, users = StandInFiles(server_major=5), StandInUsers()
+        broker = FileEventBroker(files, users)
+        alice, bob = ObjectId(), ObjectId()
+        alice_queue = broker.subscribe(alice)
+        bob_queue = broker.subscribe(bob)
+
+        doc = _file_doc(alice)
+        files.emit(delete_event(doc, with_pre_image=False))
+        users.emit(files_version_event(alice, 4))
+
+        events = await _drain(alice_queue, 1)
+        await _settle()
+        await broker.close()
+        return events, bob_queue, users
+
+    events, bob_queue, users = asyncio.run(scenario())
+    assert events == [{"type": "resync"}]
+    assert bob_queue.empty()
+    assert len(users.watch_calls) == 1
+
+
+def test_users_not_watched_when_pre_images_exist():
+    async def scenario():
+        users = StandInUsers()
+        broker = FileEventBroker(StandInFiles(), users)
+        broker.subscribe(ObjectId())
+        await _settle()
+        await broker.close()
+        return users
+
+    assert asyncio.run(scenario()).watch_calls == []
+
+
+def test_failing_users_stream_restarts_both_streams():
+    async def scenario():
+        files, users = StandInFiles(server_major=5), StandInUsers()
+        broker = FileEventBroker(files, users, restart_delay=0)
+        queue = broker.subscribe(ObjectId())
+        await _settle()
+        users.emit(OperationFailure("history lost", code=286))
+        resync = await _drain(queue, 1)
+        await _settle()
+        await broker.close()
+        return resync, files, users
+
+    resync, files, users = asyncio.run(scenario())
+    assert resync == [{"type": "resync"}]
+    assert len(files.watch_calls) == 2
+    assert len(users.watch_calls) == 2
+
+
+def test_full_queue_is_replaced_by_resync():
+    broker = FileEventBroker(files=None, users=None, queue_size=2)
+    user = ObjectId()
+    queue = asyncio.Queue(maxsize=2)
+    broker._subscribers[str(user)] = {queue}
+
+    for i in range(3):
+        broker.publish(user, {"type": "insert", "file": {"id": str(i)}})
+
+    assert queue.qsize() == 1
+    assert queue.get_nowait() == {"type": "resync"}
+
+
+def test_bad_document_does_not_stop_the_feed():
+    async def scenario():
+        files = StandInFiles()
+        broker = FileEventBroker(files, users=None)
+        user = ObjectId()
+        queue = broker.subscribe(user)
+
+        broken = _file_doc(user)
+        del broken["upload_time"]
+        files.emit(insert_event(broken))
+        files.emit(insert_event(_file_doc(user, filename="ok.txt")))
+
+        events = await _drain(queue, 1)
+        await broker.close()
+        return events
+
+    events = asyncio.run(scenario())
+    assert events[0]["file"]["filename"] == "ok.txt"
+
+
+def test_non_resumable_error_restarts_without_token_and_resyncs():
+    async def scenario():
+        files = StandInFiles()
+        broker = FileEventBroker(files, users=None, restart_delay=0)
+        user = ObjectId()
+        queue = broker.subscribe(user)
+
+        files.emit(insert_event(_file_doc(user)))
+        first = await _drain(queue, 1)
+        files.emit(OperationFailure("history lost", code=286))
+        resync = await _drain(queue, 1)
+        files.emit(insert_event(_file_doc(user, filename="after.txt")))
+        after = await _drain(queue, 1)
+        await broker.close()
+        return first, resync, after, files
+
+    first, resync, after, files = asyncio.run(scenario())
+    assert first[0]["type"] == "insert"
+    assert resync == [{"type": "resync"}]
+    assert after[0]["file"]["filename"] == "after.txt"
+    assert len(files.watch_calls) == 2
+    assert files.watch_calls[1]["resume_after"] is None
+
+
+def test_poll_diff_reports_inserts_renames_and_deletes():
+    broker = FileEventBroker(files=None, users=None)
+    user = ObjectId()
+    queue = asyncio.Queue()
+    broker._subscribers[str(user)] = {queue}
+
+    kept = _file_doc(user, filename="kept.txt")
+    renamed = _file_doc(user, filename="old.txt")
+    removed = _file_doc(user, filename="gone.txt")
+    added = _file_doc(user, filename="new.txt")
+    before = {str(d["_id"]): d for d in (kept, renamed, removed)}
+    after = {str(d["_id"]): d for d in (kept, dict(renamed, filename="new-name.txt"), added)}
+
+    broker._diff(str(user), before, after)
+
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    by_type = {e["type"]: e["file"] for e in events}
+    assert len(events) == 3
+    assert by_type["insert"]["id"] == str(added["_id"])
+    assert by_type["rename"] == {"id": str(renamed["_id"]), "filename": "new-name.txt"}
+    assert by_type["delete"] == {"id": str(removed["_id"])}
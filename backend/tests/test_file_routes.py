@@ -0,0 +1,274 @@
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+
+from app.db import get_blob_collection, get_file_collection, get_user_collection
+from app.main import app
+from app.models.user_model import User
+from app.routes import file_routes
+from app.utils.auth import get_current_user
+from app.utils.crypto_utils import STREAM_FORMAT, StreamEncryptor, generate_data_key
+from app.utils.disk_cache import DiskObjectCache, get_download_cache
+
+
+def _login_as(is_admin: bool):
+    user = User(_id=ObjectId(), username="someone", hashed_password="x", is_admin=is_admin)
+    app.dependency_overrides[get_current_user] = lambda: user
+
+
+@pytest.fixture(autouse=True)
+def _clear_overrides():
+    yield
+    app.dependency_overrides.clear()
+
+
+@pytest.mark.parametrize("path", ["/files/dedup/stats", "/files/cache/stats"])
+def test_global_stats_are_admin_only(path):
+    _login_as(is_admin=False)
+    response = TestClient(app).get(path)
+    assert response.status_code == 403
+
+
+def test_admin_can_read_cache_stats():
+    _login_as(is_admin=True)
+    response = TestClient(app).get("/files/cache/stats")
+    assert response.status_code == 200
+    assert "hit_ratio" in response.json()
+
+
+# --- Conditional GET on the listing and storage endpoints ---
+class StandInCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    async def to_list(self, length=None):
+        return list(self._docs)
+
+
+class StandInFiles:
+    def __init__(self, docs=()):
+        self.docs = {d["_id"]: d for d in docs}
+
+    def find(self, query):
+        return StandInCursor([d for d in self.docs.values() if d["owner_id"] == query["owner_id"]])
+
+    def aggregate(self, pipeline):
+        owner_id = pipeline[0]["$match"]["owner_id"]
+        total = sum(d["file_size"] for d in self.docs.values() if d["owner_id"] == owner_id)
+        return StandInCursor([{"_id": None, "total_usage": total}])
+
+    async def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+    async def insert_one(self, doc):
+        doc["_id"] = ObjectId()
+        self.docs[doc["_id"]] = doc
+        return type("InsertOneResult", (), {"inserted_id": doc["_id"]})()
+
+    async def update_one(self, query, update):
+        self.docs[query["_id"]].update(update["$set"])
+
+    async def delete_one(self, query):
+        self.docs.pop(query["_id"], None)
+
+
+class UntouchableFiles:
+    """Proves a 304 is answered without querying the files collection."""
+
+    def find(self, *args, **kwargs):
+        raise AssertionError("files.find called for a conditional GET hit")
+
+    def aggregate(self, *args, **kwargs):
+        raise AssertionError("files.aggregate called for a conditional GET hit")
+
+
+class StandInUsers:
+    def __init__(self, user_doc):
+        self.user_doc = user_doc
+
+    async def update_one(self, query, update):
+        for field, amount in update.get("$inc", {}).items():
+            self.user_doc[field] = self.user_doc.get(field, 0) + amount
+
+
+class StubS3:
+    def delete_object(self, **kwargs):
+        pass
+
+
+@pytest.fixture
+def user_doc():
+    return {"_id": ObjectId(), "username": "someone", "hashed_password": "x", "files_version": 3}
+
+
+def _serve(user_doc, files):
+    users = StandInUsers(user_doc)
+    # Re-read the user on every request, like the real dependency does
+    app.dependency_overrides[get_current_user] = lambda: User(**users.user_doc)
+    app.dependency_overrides[get_file_collection] = lambda: files
+    app.dependency_overrides[get_user_collection] = lambda: users
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("path", ["/files/", "/files/users/me/storage"])
+def test_matching_etag_gets_304_without_touching_files(user_doc, path):
+    etag = _serve(user_doc, StandInFiles()).get(path).headers["ETag"]
+    assert etag.startswith('W/"')
+
+    client = _serve(user_doc, UntouchableFiles())
+    bare = etag.removeprefix("W/")
+    for if_none_match in [etag, bare, f'"other", {bare}', "*"]:
+        response = client.get(path, headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+
+def test_every_mutation_invalidates_the_etag(user_doc, monkeypatch):
+    monkeypatch.setattr(file_routes, "s3_client", StubS3())
+    owner_id = user_doc["_id"]
+    existing = {"_id": ObjectId(), "filename": "a.txt", "owner_id": owner_id,
+                "file_path": "k", "upload_time": datetime(2024, 1, 1), "file_size": 10}
+    client = _serve(user_doc, StandInFiles([existing]))
+
+    mutations = [
+        lambda: client.post("/files/finalize-upload", json={"filename": "b.txt", "s3_key": "k2", "file_size": 5}),
+        lambda: client.patch(f"/files/{existing['_id']}", json={"new_filename": "c.txt"}),
+        lambda: client.delete(f"/files/{existing['_id']}"),
+    ]
+    for mutate in mutations:
+        listing_etag = client.get("/files/").headers["ETag"]
+        storage_etag = client.get("/files/users/me/storage").headers["ETag"]
+        assert mutate().status_code < 300
+
+        listing = client.get("/files/", headers={"If-None-Match": listing_etag})
+        storage = client.get("/files/users/me/storage", headers={"If-None-Match": storage_etag})
+        assert listing.status_code == 200
+        assert storage.status_code == 200
+        assert listing.headers["ETag"] != listing_etag
+
+
+# --- Proxied download sizing ---
+class StubBody:
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def iter_chunks(self, size):
+        for i in range(0, len(self.content), size):
+            yield self.content[i:i + size]
+
+
+class StubDownloadS3:
+    def __init__(self, content: bytes, reported_length: int = None):
+        self.content = content
+        self.reported_length = len(content) if reported_length is None else reported_length
+        self.get_calls = []
+
+    def head_object(self, **kwargs):
+        return {"ETag": '"etag-1"', "ContentLength": self.reported_length}
+
+    def get_object(self, **kwargs):
+        self.get_calls.append(kwargs)
+        return {"Body": StubBody(self.content)}
+
+
+def _serve_download(user_doc, monkeypatch, tmp_path, s3, claimed_size):
+    monkeypatch.setattr(file_routes, "s3_client", s3)
+    doc = {"_id": ObjectId(), "filename": "big.bin", "owner_id": user_doc["_id"],
+           "file_path": "k", "upload_time": datetime(2024, 1, 1), "file_size": claimed_size}
+    files = StandInFiles([doc])
+    cache = DiskObjectCache(str(tmp_path), max_bytes=8000)  # entries up to 1000 bytes
+    client = _serve(user_doc, files)
+    app.dependency_overrides[get_download_cache] = lambda: cache
+    return client, doc, cache
+
+
+def test_cache_decision_uses_s3_size_not_client_size(user_doc, monkeypatch, tmp_path):
+    s3 = StubDownloadS3(b"x" * 5000)
+    client, doc, cache = _serve_download(user_doc, monkeypatch, tmp_path, s3, claimed_size=1)
+
+    response = client.get(f"/files/download/{doc['_id']}")
+
+    assert response.status_code == 200
+    assert response.content == s3.content
+    assert "IfMatch" not in s3.get_calls[0]  # streamed directly, not through the cache
+    assert cache.stats()["entries"] == 0
+    assert doc["s3_size"] == 5000
+
+
+def test_cache_fill_aborts_when_object_outgrows_limit(user_doc, monkeypatch, tmp_path):
+    s3 = StubDownloadS3(b"x" * 5000, reported_length=10)
+    client, doc, cache = _serve_download(user_doc, monkeypatch, tmp_path, s3, claimed_size=10)
+
+    response = client.get(f"/files/download/{doc['_id']}")
+
+    assert response.status_code == 500
+    assert cache.stats()["entries"] == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_encrypted_download_round_trip(user_doc, monkeypatch, tmp_path):
+    data_key, envelope = generate_data_key()
+    encryptor = StreamEncryptor(data_key, chunk_size=1024)
+    s3 = StubDownloadS3(encryptor.update(b"secret " * 500) + encryptor.finalize())
+    client, doc, _ = _serve_download(user_doc, monkeypatch, tmp_path, s3, claimed_size=3500)
+    doc["encryption"] = dict(envelope, format=STREAM_FORMAT)
+
+    response = client.get(f"/files/download/{doc['_id']}")
+
+    assert response.status_code == 200
+    assert response.content == b"secret " * 500
+
+
+def test_bad_envelope_fails_before_the_response_starts(user_doc, monkeypatch, tmp_path):
+    s3 = StubDownloadS3(b"x" * 100)
+    client, doc, _ = _serve_download(user_doc, monkeypatch, tmp_path, s3, claimed_size=100)
+    doc["encryption"] = {"kek_id": "no-such-kek", "wrapped_key": "AAAA", "format": STREAM_FORMAT}
+
+    response = client.get(f"/files/download/{doc['_id']}")
+
+    assert response.status_code == 500
+    assert "unwrap" in response.json()["detail"]
+    assert s3.get_calls == []
+
+
+# --- Deduplicated uploads ---
+class StubUploadS3:
+    def __init__(self):
+        self.uploaded_keys = []
+        self.deleted_keys = []
+
+    def create_multipart_upload(self, Key, **kwargs):
+        self.uploaded_keys.append(Key)
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, PartNumber, **kwargs):
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+    def delete_object(self, Key, **kwargs):
+        self.deleted_keys.append(Key)
+
+
+def test_duplicate_upload_is_deleted_in_the_background(user_doc, monkeypatch):
+    s3 = StubUploadS3()
+    monkeypatch.setattr(file_routes, "s3_client", s3)
+    existing_blob = {"_id": "hash", "s3_key": "blobs/existing", "size": 5,
+                     "encryption": {"kek_id": "k", "wrapped_key": "AAAA"}, "refcount": 2}
+
+    async def claim_existing(blobs, content_hash, s3_key, size, encryption):
+        return existing_blob, False
+
+    monkeypatch.setattr(file_routes, "claim_blob", claim_existing)
+    client = _serve(user_doc, StandInFiles())
+    app.dependency_overrides[get_blob_collection] = lambda: None
+
+    response = client.post("/files/upload?filename=a.txt&encrypt=true", content=b"hello")
+
+    assert response.status_code == 200
+    # Only our redundant copy goes, after the response; the shared object stays
+    assert s3.deleted_keys == s3.uploaded_keys
+    assert "blobs/existing" not in s3.deleted_keys
@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.utils.crypto_utils import StreamEncryptor, StreamDecryptor
+from app.utils.s3_streaming import stream_to_s3
+
+
+class StubS3:
+    """Records multipart calls; upload_part can be slowed down or made to fail."""
+
+    def __init__(self, part_delay: float = 0.0, fail_part: int = None):
+        self.part_delay = part_delay
+        self.fail_part = fail_part
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.part_delay)
+            if PartNumber == self.fail_part:
+                raise RuntimeError("part upload failed")
+            self.parts[PartNumber] = Body
+            return {"ETag": f'"{PartNumber}"'}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):
+        self.completed = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+    def body(self) -> bytes:
+        return b"".join(self.parts[n] for n in sorted(self.parts))
+
+
+async def _chunks(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def test_parts_are_bounded_and_reassemble():
+    data = bytes(range(256)) * 400  # 102400 bytes
+    s3 = StubS3(part_delay=0.01)
+
+    read = asyncio.run(stream_to_s3(
+        s3, "bucket", "key", _chunks(data, 1000), part_size=4096, max_in_flight=3
+    ))
+
+    assert read == len(data)
+    assert s3.body() == data
+    assert s3.completed == list(range(1, len(s3.parts) + 1))
+    assert 1 < s3.max_in_flight <= 3
+
+
+def test_empty_body_uploads_a_single_empty_part():
+    s3 = StubS3()
+
+    read = asyncio.run(stream_to_s3(s3, "bucket", "key", _chunks(b"", 1), part_size=4096))
+
+    assert read == 0
+    assert s3.parts == {1: b""}
+    assert s3.completed == [1]
+
+
+def test_failed_part_aborts_the_upload():
+    s3 = StubS3(fail_part=2)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(stream_to_s3(
+            s3, "bucket", "key", _chunks(b"x" * 50000, 1000), part_size=4096, max_in_flight=2
+        ))
+
+    assert s3.aborted
+    assert s3.completed is None
+
+
+def test_encrypted_upload_round_trip():
+    key = b"k" * 32
+    data = b"hello world " * 5000
+    s3 = StubS3()
+
+    read = asyncio.run(stream_to_s3(
+        s3, "bucket", "key", _chunks(data, 777), part_size=4096,
+        encryptor=StreamEncryptor(key, chunk_size=1024)
+    ))
+
+    assert read == len(data)
+    decryptor = StreamDecryptor(key)
+    plaintext = decryptor.update(s3.body())
+    decryptor.finalize()
+    assert plaintext == data
+
+
+def test_encryption_runs_off_the_event_loop():
+    key = b"k" * 32
+    data = b"x" * 10_000
+
+    class RecordingEncryptor(StreamEncryptor):
+        threads = set()
+
+        def _frame(self, chunk, final):
+            self.threads.add(threading.get_ident())
+            return super()._frame(chunk, final)
+
+    async def scenario():
+        loop_thread = threading.get_ident()
+        encryptor = RecordingEncryptor(key, chunk_size=1024)
+        await stream_to_s3(StubS3(), "bucket", "key", _chunks(data, 100), part_size=4096, encryptor=encryptor)
+        return loop_thread, encryptor.threads
+
+    loop_thread, threads = asyncio.run(scenario())
+    assert threads and loop_thread not in threads
+
+
+@pytest.mark.parametrize("size", [0, 1024, 1025, 4096])
+def test_stream_encryption_round_trip(size):
+    key = b"k" * 32
+    data = bytes(i % 251 for i in range(size))
+    encryptor = StreamEncryptor(key, chunk_size=1024)
+    ciphertext = encryptor.update(data) + encryptor.finalize()
+
+    decryptor = StreamDecryptor(key)
+    # Feed it in awkward pieces to exercise frame reassembly
+    plaintext = b"".join(decryptor.update(ciphertext[i:i + 100]) for i in range(0, len(ciphertext), 100))
+    decryptor.finalize()
+    assert plaintext == data
+
+
+def test_truncated_stream_is_rejected():
+    key = b"k" * 32
+    encryptor = StreamEncryptor(key, chunk_size=1024)
+    ciphertext = encryptor.update(b"a" * 3000) + encryptor.finalize()
+
+    # Drop the final frame: every remaining frame is valid on its own
+    decryptor = StreamDecryptor(key)
+    frames = []
+    rest = ciphertext
+    while rest:
+        length = int.from_bytes(rest[:4], "big")
+        frames.append(rest[:5 + length])
+        rest = rest[5 + length:]
+    decryptor.update(b"".join(frames[:-1]))
+    with pytest.raises(ValueError):
+        decryptor.finalize()
+
+    # Cutting a frame in half is caught too
+    decryptor = StreamDecryptor(key)
+    decryptor.update(ciphertext[:-10])
+    with pytest.raises(ValueError):
+        decryptor.finalize()
+
+
+def test_tampered_frame_is_rejected():
+    key = b"k" * 32
+    encryptor = StreamEncryptor(key, chunk_size=1024)
+    ciphertext = bytearray(encryptor.update(b"a" * 3000) + encryptor.finalize())
+    ciphertext[40] ^= 1
+
+    with pytest.raises(ValueError):
+        StreamDecryptor(key).update(bytes(ciphertext))